@@ -5,125 +5,235 @@ Handles periodic tasks like subscription checks, notifications, and cleanup
 
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Any
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Tuple
 
 from database import Database
-from marzban_client import MarzbanClient
+from marzban_client import MarzbanClient, APIError
+from tariffs import get_tariff, reload_tariffs
+from throttling import TelegramLimiter
 from yoomoney_client import YooMoneyClient
 
 logger = logging.getLogger(__name__)
 
+# Max in-flight Marzban/Telegram calls per background job
+MAX_CONCURRENT_REQUESTS = 10
 
-async def check_expired_subscriptions(db: Database, marzban_client: MarzbanClient, bot):
+# Job cadences in seconds
+EXPIRED_CHECK_INTERVAL = 5 * 60
+NOTIFY_INTERVAL = 30 * 60
+TRAFFIC_SYNC_INTERVAL = 15 * 60
+CLEANUP_INTERVAL = 24 * 60 * 60
+TARIFFS_RELOAD_INTERVAL = 60
+
+# Seconds a fetched Marzban user is reused by notification passes
+MARZBAN_USER_CACHE_TTL = 300
+_marzban_user_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
+async def check_expired_subscriptions(
+    db: Database,
+    marzban_client: MarzbanClient,
+    bot,
+    limiter: TelegramLimiter
+):
     """Check and handle expired subscriptions"""
     try:
-        expired = await db.get_expired_subscriptions()
-        
-        for sub in expired:
-            try:
-                # Delete user from Marzban
-                await marzban_client.delete_user(sub["marzban_username"])
-                
-                # Update subscription status
-                await db.update_subscription_status(sub["id"], "expired")
-                
-                # Notify user
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def handle(sub):
+            async with semaphore:
                 try:
-                    await bot.send_message(
-                        sub["telegram_id"],
-                        f"⏰ Ваша подписка истекла!\n\n"
-                        f"📦 Тариф: {sub['tariff_id']}\n"
-                        f"📅 Истекла: {sub['expires_at']}\n\n"
-                        f"Нажмите 💰 Тарифы чтобы продлить."
-                    )
+                    # Delete user from Marzban; a 404 means it is already gone
+                    try:
+                        await marzban_client.delete_user(sub["marzban_username"])
+                    except APIError as e:
+                        if e.status != 404:
+                            raise
+
+                    # Update subscription status
+                    await db.update_subscription_status(sub["id"], "expired")
+
+                    # Notify user
+                    try:
+                        await limiter.send_message(
+                            bot,
+                            sub["telegram_id"],
+                            f"⏰ Ваша подписка истекла!\n\n"
+                            f"📦 Тариф: {sub['tariff_id']}\n"
+                            f"📅 Истекла: {sub['expires_at']}\n\n"
+                            f"Нажмите 💰 Тарифы чтобы продлить."
+                        )
+                    except Exception as e:
+                        logger.error(f"Failed to notify user {sub['telegram_id']}: {e}")
+
+                    logger.info(f"Expired subscription processed for user {sub['telegram_id']}")
+
                 except Exception as e:
-                    logger.error(f"Failed to notify user {sub['telegram_id']}: {e}")
-                
-                logger.info(f"Expired subscription processed for user {sub['telegram_id']}")
-                
-            except Exception as e:
-                logger.error(f"Error processing expired subscription {sub['id']}: {e}")
-        
-        if expired:
-            logger.info(f"Processed {len(expired)} expired subscriptions")
+                    logger.error(f"Error processing expired subscription {sub['id']}: {e}")
+
+        # Start processing each row as soon as it is fetched
+        tasks = [asyncio.create_task(handle(sub)) async for sub in db.get_expired_subscriptions()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if tasks:
+            logger.info(f"Processed {len(tasks)} expired subscriptions")
             
     except Exception as e:
         logger.error(f"Error in check_expired_subscriptions: {e}")
 
 
-async def send_expiration_notifications(
+async def get_marzban_users_cached(
+    marzban_client: MarzbanClient,
+    usernames: List[str]
+) -> Dict[str, Dict[str, Any]]:
+    """Get Marzban users in bulk, reusing lookups younger than MARZBAN_USER_CACHE_TTL"""
+    now = time.monotonic()
+    users = {}
+    missing = []
+    for username in usernames:
+        cached = _marzban_user_cache.get(username)
+        if cached and now - cached[0] < MARZBAN_USER_CACHE_TTL:
+            users[username] = cached[1]
+        else:
+            missing.append(username)
+
+    if missing:
+        fetched = await marzban_client.get_users_bulk(missing)
+        for username, marzban_user in fetched.items():
+            _marzban_user_cache[username] = (now, marzban_user)
+        users.update(fetched)
+
+    return users
+
+
+async def send_all_expiration_notifications(
     db: Database,
     marzban_client: MarzbanClient,
     bot,
-    hours_before: int = 24
+    limiter: TelegramLimiter,
+    notify_hours: List[int]
 ):
-    """Send notifications for expiring subscriptions"""
+    """Send notifications for subscriptions expiring within any of the notify windows"""
     try:
-        expiring = await db.get_expiring_subscriptions(hours_before)
-        
-        for sub in expiring:
-            try:
-                # Get actual usage from Marzban
+        # Drop stale cache entries so the cache only holds recently expiring users
+        now = time.monotonic()
+        for username, (fetched_at, _) in list(_marzban_user_cache.items()):
+            if now - fetched_at >= MARZBAN_USER_CACHE_TTL:
+                del _marzban_user_cache[username]
+
+        # One message per (user, window); every subscription folded into it is marked notified
+        expiring: Dict[Tuple[int, int], List[Any]] = {}
+        async for sub in db.get_expiring_subscriptions(notify_hours):
+            expiring.setdefault((sub["telegram_id"], sub["notify_window"]), []).append(sub)
+
+        # Actual usage for every recipient in one bulk lookup
+        try:
+            marzban_users = await get_marzban_users_cached(
+                marzban_client,
+                list({sub["marzban_username"] for subs in expiring.values() for sub in subs})
+            ) if expiring else {}
+        except Exception as e:
+            logger.error(f"Failed to fetch Marzban users for notifications: {e}")
+            marzban_users = {}
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def handle(subs):
+            # The soonest-expiring subscription drives the message
+            sub = min(subs, key=lambda s: s["hours_total"])
+            async with semaphore:
                 try:
-                    marzban_user = await marzban_client.get_user(sub["marzban_username"])
-                    traffic_used = marzban_client.format_traffic(marzban_user.get("used_traffic", 0))
-                    traffic_limit = marzban_client.format_traffic(marzban_user.get("data_limit", 0))
-                except Exception:
-                    traffic_used = f"{sub.get('traffic_used_gb', 0):.2f} GB"
-                    traffic_limit = f"{sub['traffic_limit_gb']:.2f} GB"
-                
-                time_left = datetime.fromisoformat(sub["expires_at"]) - datetime.utcnow()
-                days_left = time_left.days
-                hours_left = time_left.seconds // 3600
-                
-                text = (
-                    f"⚠️ Подписка скоро истекает!\n\n"
-                    f"⏳ Осталось: {days_left} дн. {hours_left} ч.\n"
-                    f"📊 Трафик: {traffic_used} / {traffic_limit}\n\n"
-                    f"Нажмите 💰 Тарифы чтобы продлить."
-                )
-                
-                await bot.send_message(sub["telegram_id"], text)
-                logger.info(f"Sent expiration notification to user {sub['telegram_id']}")
-                
-            except Exception as e:
-                logger.error(f"Failed to notify user {sub['telegram_id']}: {e}")
-        
+                    marzban_user = marzban_users.get(sub["marzban_username"])
+                    if marzban_user:
+                        traffic_used = marzban_client.format_traffic(marzban_user.get("used_traffic", 0))
+                        traffic_limit = marzban_client.format_traffic(marzban_user.get("data_limit", 0))
+                    else:
+                        traffic_used = f"{sub['traffic_used_gb']:.2f} GB"
+                        traffic_limit = f"{sub['traffic_limit_gb']:.2f} GB"
+
+                    days_left, hours_left = divmod(sub["hours_total"], 24)
+
+                    text = (
+                        f"⚠️ Подписка скоро истекает!\n\n"
+                        f"⏳ Осталось: {days_left} дн. {hours_left} ч.\n"
+                        f"📊 Трафик: {traffic_used} / {traffic_limit}\n\n"
+                        f"Нажмите 💰 Тарифы чтобы продлить."
+                    )
+
+                    await limiter.send_message(bot, sub["telegram_id"], text)
+                    await asyncio.gather(*(
+                        db.set_notified_bucket(folded["id"], folded["notify_window"])
+                        for folded in subs
+                    ))
+                    logger.info(f"Sent expiration notification to user {sub['telegram_id']}")
+
+                except Exception as e:
+                    logger.error(f"Failed to notify user {sub['telegram_id']}: {e}")
+
+        await asyncio.gather(*(handle(subs) for subs in expiring.values()), return_exceptions=True)
+
         if expiring:
             logger.info(f"Sent {len(expiring)} expiration notifications")
             
     except Exception as e:
-        logger.error(f"Error in send_expiration_notifications: {e}")
+        logger.error(f"Error in send_all_expiration_notifications: {e}")
 
 
 async def sync_traffic_usage(db: Database, marzban_client: MarzbanClient):
     """Sync traffic usage from Marzban to database"""
     try:
-        # Get all active subscriptions
-        cursor = await db._connection.execute(
-            "SELECT * FROM subscriptions WHERE status = 'active'"
+        subscriptions = [sub async for sub in db.get_active_subscriptions_for_sync()]
+        if not subscriptions:
+            return
+
+        # One bulk Marzban lookup instead of a request per subscription
+        marzban_users = await marzban_client.get_users_bulk(
+            list({sub["marzban_username"] for sub in subscriptions})
         )
-        subscriptions = [dict(row) for row in await cursor.fetchall()]
-        
+
+        # A user missing from the bulk response is only orphaned once Marzban confirms a 404
+        missing = list({sub["marzban_username"] for sub in subscriptions} - marzban_users.keys())
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def verify(username: str):
+            async with semaphore:
+                return await marzban_client.get_user(username)
+
+        results = await asyncio.gather(*(verify(username) for username in missing), return_exceptions=True)
+        deleted = set()
+        for username, result in zip(missing, results):
+            if isinstance(result, APIError) and result.status == 404:
+                deleted.add(username)
+            elif isinstance(result, Exception):
+                logger.error(f"Could not verify Marzban user {username}, skipping until next sync: {result}")
+            else:
+                marzban_users[username] = result
+
+        updates = []
+        orphaned = []
         for sub in subscriptions:
-            try:
-                # Get user info from Marzban
-                user = await db.get_user(sub["telegram_id"])
-                if not user:
-                    continue
-                
-                marzban_user = await marzban_client.get_user(user["marzban_username"])
-                used_traffic = marzban_user.get("used_traffic", 0)
-                used_traffic_gb = used_traffic / (1024 * 1024 * 1024)
-                
-                # Update database
-                await db.update_subscription_traffic(sub["id"], used_traffic_gb)
-                
-            except Exception as e:
-                logger.error(f"Failed to sync traffic for subscription {sub['id']}: {e}")
-        
-        logger.info(f"Synced traffic for {len(subscriptions)} subscriptions")
+            marzban_user = marzban_users.get(sub["marzban_username"])
+            if marzban_user is not None:
+                updates.append((marzban_user.get("used_traffic", 0), sub["id"]))
+            elif sub["marzban_username"] in deleted:
+                orphaned.append(sub["id"])
+
+        # Subscriptions whose Marzban user is gone are taken out of future cycles
+        if orphaned:
+            await asyncio.gather(*(
+                db.update_subscription_status(subscription_id, "orphaned")
+                for subscription_id in orphaned
+            ))
+            logger.warning(f"Marked {len(orphaned)} subscriptions without a Marzban user as orphaned")
+
+        # Write all changed usage values in one transaction
+        changed = await db.update_subscriptions_traffic(updates) if updates else 0
+
+        logger.info(
+            f"Synced traffic for {len(updates)} of {len(subscriptions)} subscriptions ({changed} changed)"
+        )
         
     except Exception as e:
         logger.error(f"Error in sync_traffic_usage: {e}")
@@ -133,65 +243,91 @@ async def cleanup_old_payments(db: Database, days_old: int = 30):
     """Clean up old processed payments"""
     try:
         cutoff_date = datetime.utcnow() - timedelta(days=days_old)
-        
-        cursor = await db._connection.execute(
-            """
-            SELECT id FROM payments 
-            WHERE status IN ('approved', 'rejected') 
-            AND reviewed_at < ?
-            """,
-            (cutoff_date.isoformat(),)
-        )
-        
-        old_payments = [row[0] for row in await cursor.fetchall()]
-        
-        for payment_id in old_payments:
-            await db._connection.execute("DELETE FROM payments WHERE id = ?", (payment_id,))
-        
-        await db._connection.commit()
-        
-        if old_payments:
-            logger.info(f"Cleaned up {len(old_payments)} old payments")
+        deleted = await db.delete_old_payments(cutoff_date)
+
+        if deleted:
+            logger.info(f"Cleaned up {deleted} old payments")
         
     except Exception as e:
         logger.error(f"Error in cleanup_old_payments: {e}")
 
 
-async def periodic_tasks(db: Database, marzban_client: MarzbanClient, bot, config):
-    """Run all periodic tasks"""
-    while True:
-        try:
-            logger.info("Running periodic tasks...")
-
-            # Check expired subscriptions
-            await check_expired_subscriptions(db, marzban_client, bot)
+async def run_periodically(name: str, interval: float, job, initial_delay: float = 0):
+    """Run a job every `interval` seconds on the monotonic clock"""
+    loop = asyncio.get_running_loop()
+    next_run = loop.time() + initial_delay
 
-            # Send expiration notifications
-            notify_hours = config.NOTIFY_BEFORE_EXPIRE_HOURS or [24, 48, 72]
-            for hours in notify_hours:
-                await send_expiration_notifications(db, marzban_client, bot, hours)
+    while True:
+        await asyncio.sleep(max(0, next_run - loop.time()))
 
-            # Sync traffic usage
-            await sync_traffic_usage(db, marzban_client)
+        try:
+            await job()
+        except Exception as e:
+            logger.error(f"Error in periodic task {name}: {e}")
 
-            # Cleanup old payments (once a day)
-            await cleanup_old_payments(db)
+        # Keep a fixed cadence, but skip runs missed while the job was busy
+        next_run += interval
+        if next_run < loop.time():
+            next_run = loop.time() + interval
 
-            logger.info("Periodic tasks completed")
 
-        except Exception as e:
-            logger.error(f"Error in periodic tasks: {e}")
+async def periodic_tasks(
+    db: Database,
+    marzban_client: MarzbanClient,
+    bot,
+    config,
+    limiter: TelegramLimiter
+):
+    """Run all periodic tasks, each on its own cadence"""
+    notify_hours = config.NOTIFY_BEFORE_EXPIRE_HOURS or (24, 48, 72)
 
-        # Run every hour
-        await asyncio.sleep(3600)
+    # Start offsets spread the first runs so the jobs don't fire together
+    await asyncio.gather(
+        run_periodically(
+            "check_expired_subscriptions",
+            EXPIRED_CHECK_INTERVAL,
+            lambda: check_expired_subscriptions(db, marzban_client, bot, limiter)
+        ),
+        run_periodically(
+            "send_all_expiration_notifications",
+            NOTIFY_INTERVAL,
+            lambda: send_all_expiration_notifications(db, marzban_client, bot, limiter, notify_hours),
+            initial_delay=60
+        ),
+        run_periodically(
+            "sync_traffic_usage",
+            TRAFFIC_SYNC_INTERVAL,
+            lambda: sync_traffic_usage(db, marzban_client),
+            initial_delay=120
+        ),
+        run_periodically(
+            "cleanup_old_payments",
+            CLEANUP_INTERVAL,
+            lambda: cleanup_old_payments(db),
+            initial_delay=300
+        ),
+        # Picks up edits to the tariffs file without touching disk in handlers
+        run_periodically(
+            "reload_tariffs",
+            TARIFFS_RELOAD_INTERVAL,
+            reload_tariffs,
+            initial_delay=TARIFFS_RELOAD_INTERVAL
+        )
+    )
 
 
-async def start_background_tasks(db: Database, marzban_client: MarzbanClient, bot, config):
+async def start_background_tasks(
+    db: Database,
+    marzban_client: MarzbanClient,
+    bot,
+    config,
+    limiter: TelegramLimiter
+):
     """Start all background tasks"""
     logger.info("Starting background tasks...")
 
     # Start periodic tasks
-    asyncio.create_task(periodic_tasks(db, marzban_client, bot, config))
+    asyncio.create_task(periodic_tasks(db, marzban_client, bot, config, limiter))
     # asyncio.create_task(check_yoomoney_payments)(db, marzban_client, bot, config))
 
     logger.info("Background tasks started")
@@ -219,10 +355,10 @@ async def check_yoomoney_payments(db: Database, marzban_client: MarzbanClient, b
             
             for payment in pending_payments:
                 payment_id = payment["id"]
-                payment_comment = payment.get("payment_comment", "")
-                amount = payment.get("amount", 0)
-                telegram_id = payment.get("telegram_id")
-                tariff_id = payment.get("tariff_id")
+                payment_comment = payment["payment_comment"]
+                amount = payment["amount"]
+                telegram_id = payment["telegram_id"]
+                tariff_id = payment["tariff_id"]
                 
                 if not payment_comment:
                     continue
@@ -234,14 +370,10 @@ async def check_yoomoney_payments(db: Database, marzban_client: MarzbanClient, b
                     await db.approve_payment(payment_id, "auto")
                     
                     # Get tariff and activate subscription
-                    import json
                     import random
                     import string
-                    from datetime import datetime, timedelta
                     
-                    with open("data/tarifs.json", "r", encoding="utf-8") as f:
-                        tariffs_data = json.load(f)
-                    tariff = next((t for t in tariffs_data["tariffs"] if t["id"] == tariff_id), None)
+                    tariff = get_tariff(tariff_id)
                     
                     if tariff:
                         user = await db.get_user(telegram_id)
@@ -264,7 +396,7 @@ async def check_yoomoney_payments(db: Database, marzban_client: MarzbanClient, b
                                     inbounds={"shadowsocks": ["Shadowsocks TCP"], "vless": ["VLESS WS"]}
                                 )
                                 
-                                expires_at = datetime.utcnow() + timedelta(days=tariff["duration_days"])
+                                expires_at = datetime.fromtimestamp(expire, tz=timezone.utc)
                                 await db.add_subscription(
                                     telegram_id=telegram_id,
                                     tariff_id=tariff_id,
@@ -273,7 +405,7 @@ async def check_yoomoney_payments(db: Database, marzban_client: MarzbanClient, b
                                     is_trial=False
                                 )
                                 
-                                sub_link = f"https://94.176.3.195:8443/sub/{marzban_username}"
+                                sub_link = marzban_client.get_subscription_link(marzban_username)
                                 await bot.send_message(
                                     telegram_id,
                                     f"✅ Оплата подтверждена!\n\n"
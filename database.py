@@ -3,32 +3,241 @@ Database Module
 Handles SQLite database operations for users, subscriptions, and payments
 """
 
+import asyncio
 import aiosqlite
 import logging
-from typing import Optional, List, Dict, Any
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import groupby
+from typing import Optional, List, Dict, Any, Tuple, AsyncIterator, NamedTuple
 from datetime import datetime
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
 
 
+class Subscription(NamedTuple):
+    """Active subscription row"""
+    id: int
+    telegram_id: int
+    tariff_id: str
+    status: str
+    created_at: str
+    expires_at: str
+    traffic_limit_gb: float
+    traffic_used_gb: float
+    is_trial: int
+    notified_bucket: Optional[int]
+
+
+_SUBSCRIPTION_COLUMNS = ", ".join(Subscription._fields)
+
+# Hot-path statements kept as constants so every call hits the same
+# entry in sqlite3's per-connection prepared statement cache
+_SQL_GET_USER = "SELECT * FROM users WHERE telegram_id = ?"
+_SQL_IS_USER_BANNED = "SELECT is_banned FROM users WHERE telegram_id = ?"
+_SQL_GET_ACTIVE_SUBSCRIPTION = f"""
+    SELECT {_SUBSCRIPTION_COLUMNS} FROM subscriptions
+    WHERE telegram_id = ? AND status = 'active' AND expires_at > CURRENT_TIMESTAMP
+    ORDER BY expires_at DESC
+    LIMIT 1
+"""
+_SQL_HAS_USED_TRIAL = "SELECT COUNT(*) FROM subscriptions WHERE telegram_id = ? AND is_trial = 1"
+_SQL_ADD_SUBSCRIPTION = """
+    INSERT INTO subscriptions (telegram_id, tariff_id, expires_at, traffic_limit_gb, is_trial)
+    VALUES (?, ?, ?, ?, ?)
+"""
+_SQL_UPDATE_SUBSCRIPTION_STATUS = "UPDATE subscriptions SET status = ? WHERE id = ?"
+_SQL_UPDATE_SUBSCRIPTIONS_TRAFFIC = """
+    UPDATE subscriptions SET traffic_used_gb = ? / 1073741824.0
+    WHERE id = ? AND abs(coalesce(traffic_used_gb, 0) - ? / 1073741824.0) > 0.001
+"""
+
+
 class Database:
-    def __init__(self, db_path: str = "data/users.db"):
+    # Max queued writes committed together by the writer task
+    WRITE_BATCH_SIZE = 100
+
+    # Prepared statements kept per connection (sqlite3 default is 128)
+    STATEMENT_CACHE_SIZE = 256
+
+    # Seconds a user lookup is served from memory
+    USER_CACHE_TTL = 30
+
+    # Entries kept per lookup cache before the oldest are evicted
+    CACHE_MAX_ENTRIES = 10000
+
+    # Seconds an active subscription lookup is served from memory
+    SUBSCRIPTION_CACHE_TTL = 10
+
+    # Per-connection tuning shared by the writer and the read pool
+    _READER_PRAGMAS = """
+        PRAGMA temp_store = MEMORY;
+        PRAGMA cache_size = -64000;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA busy_timeout = 5000;
+    """
+
+    def __init__(self, db_path: str = "data/users.db", read_pool_size: int = 5):
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.read_pool_size = read_pool_size
+        # Single writer connection; SELECTs go through the read-only pool
         self._connection: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        # Separate query-only connection for admin/maintenance scans
+        self._maint_conn: Optional[aiosqlite.Connection] = None
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        # Held for every transaction on the writer connection, so direct writes
+        # and the batching writer never interleave or roll back each other's work
+        self._write_lock = asyncio.Lock()
+        # telegram_id -> (fetched_at, value) for hot per-update lookups
+        self._user_cache: OrderedDict[int, Tuple[float, Optional[Dict[str, Any]]]] = OrderedDict()
+        self._banned_cache: OrderedDict[int, Tuple[float, bool]] = OrderedDict()
+        self._subscription_cache: OrderedDict[int, Tuple[float, Optional[Subscription]]] = OrderedDict()
 
     async def connect(self):
         """Initialize database connection and create tables"""
-        self._connection = await aiosqlite.connect(str(self.db_path))
+        self._connection = await aiosqlite.connect(
+            str(self.db_path), cached_statements=self.STATEMENT_CACHE_SIZE
+        )
         self._connection.row_factory = aiosqlite.Row
+        await self._configure_connection(self._connection)
         await self._create_tables()
 
+        # Readers are opened after the schema exists; WAL lets them run alongside the writer
+        self._reader_pool = asyncio.Queue()
+        for _ in range(self.read_pool_size):
+            reader = await aiosqlite.connect(
+                f"{self.db_path.resolve().as_uri()}?mode=ro",
+                uri=True,
+                cached_statements=self.STATEMENT_CACHE_SIZE
+            )
+            reader.row_factory = aiosqlite.Row
+            await reader.executescript(self._READER_PRAGMAS)
+            self._readers.append(reader)
+            self._reader_pool.put_nowait(reader)
+
+        self._maint_conn = await aiosqlite.connect(
+            str(self.db_path), cached_statements=self.STATEMENT_CACHE_SIZE
+        )
+        await self._maint_conn.executescript(self._READER_PRAGMAS + "PRAGMA query_only = 1;")
+
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer())
+
+    async def _configure_connection(self, connection: aiosqlite.Connection):
+        """Apply performance PRAGMAs (WAL lets readers run alongside the writer)"""
+        await connection.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+        """ + self._READER_PRAGMAS)
+        await connection.commit()
+
+    @asynccontextmanager
+    async def read_conn(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Borrow a read-only connection from the pool"""
+        connection = await self._reader_pool.get()
+        try:
+            yield connection
+        finally:
+            self._reader_pool.put_nowait(connection)
+
     async def close(self):
         """Close database connection"""
+        if self._writer_task:
+            if not self._writer_task.done():
+                await self._write_queue.join()
+            self._writer_task.cancel()
+            self._writer_task = None
+        for reader in self._readers:
+            await reader.close()
+        self._readers.clear()
+        if self._maint_conn:
+            await self._maint_conn.close()
+            self._maint_conn = None
         if self._connection:
             await self._connection.close()
 
+    async def _write(self, sql: str, params: tuple):
+        """Queue a write for the writer task and wait until it is committed"""
+        future = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((sql, params, future))
+        await future
+
+    async def _execute_write(self, sql: str, params, many: bool = False) -> aiosqlite.Cursor:
+        """Run one write in its own transaction on the writer connection"""
+        async with self._write_lock:
+            try:
+                if many:
+                    cursor = await self._connection.executemany(sql, params)
+                else:
+                    cursor = await self._connection.execute(sql, params)
+                await self._connection.commit()
+            except Exception:
+                await self._safe_rollback()
+                raise
+        return cursor
+
+    async def _safe_rollback(self):
+        """Roll back the writer connection without letting a failure escape"""
+        try:
+            await self._connection.rollback()
+        except Exception as e:
+            logger.error(f"Rollback failed: {e}")
+
+    async def _writer(self):
+        """Drain queued writes and commit everything pending in one transaction"""
+        while True:
+            batch = [await self._write_queue.get()]
+            while len(batch) < self.WRITE_BATCH_SIZE and not self._write_queue.empty():
+                batch.append(self._write_queue.get_nowait())
+
+            try:
+                async with self._write_lock:
+                    await self._commit_batch(batch)
+            except Exception as e:
+                # Never let the writer die; otherwise every later _write() would hang
+                logger.error(f"Writer failed on {len(batch)} queued writes: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._write_queue.task_done()
+
+    async def _commit_batch(self, batch: list):
+        """Commit a batch together, falling back to one transaction per write on failure"""
+        try:
+            # Consecutive writes of the same statement go through one executemany
+            for sql, group in groupby(batch, key=lambda item: item[0]):
+                await self._connection.executemany(sql, [params for _, params, _ in group])
+            await self._connection.commit()
+        except Exception as e:
+            logger.error(f"Failed to commit {len(batch)} queued writes, replaying one by one: {e}")
+            await self._safe_rollback()
+        else:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+            return
+
+        # Replay individually so only the failing caller sees its exception
+        for sql, params, future in batch:
+            try:
+                await self._connection.execute(sql, params)
+                await self._connection.commit()
+            except Exception as e:
+                await self._safe_rollback()
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(None)
+
     async def _create_tables(self):
         """Create database tables if they don't exist"""
         await self._connection.execute("""
@@ -54,10 +263,18 @@ class Database:
                 traffic_limit_gb REAL,
                 traffic_used_gb REAL DEFAULT 0,
                 is_trial INTEGER DEFAULT 0,
+                notified_bucket INTEGER,
                 FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
             )
         """)
 
+        # Databases created before expiry notices were deduplicated lack this column
+        cursor = await self._connection.execute("PRAGMA table_info(subscriptions)")
+        if "notified_bucket" not in {row["name"] for row in await cursor.fetchall()}:
+            await self._connection.execute(
+                "ALTER TABLE subscriptions ADD COLUMN notified_bucket INTEGER"
+            )
+
         await self._connection.execute("""
             CREATE TABLE IF NOT EXISTS payments (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -86,6 +303,23 @@ class Database:
             )
         """)
 
+        # Indexes for the periodic background queries and admin lookups
+        await self._connection.executescript("""
+            CREATE INDEX IF NOT EXISTS idx_sub_status_exp
+                ON subscriptions(status, expires_at);
+            CREATE INDEX IF NOT EXISTS idx_sub_tgid_status
+                ON subscriptions(telegram_id, status, expires_at DESC);
+            CREATE INDEX IF NOT EXISTS idx_pay_status_rev
+                ON payments(status, reviewed_at);
+            CREATE INDEX IF NOT EXISTS idx_pay_status_created
+                ON payments(status, created_at DESC);
+            CREATE INDEX IF NOT EXISTS idx_ref_referrer
+                ON referrals(referrer_id);
+            CREATE INDEX IF NOT EXISTS idx_users_username
+                ON users(username);
+        """)
+
+        await self._connection.execute("ANALYZE")
         await self._connection.commit()
         logger.info("Database initialized")
 
@@ -99,73 +333,133 @@ class Database:
         referred_by: Optional[int] = None
     ):
         """Add a new user to the database"""
-        await self._connection.execute(
+        await self._execute_write(
             """
             INSERT INTO users (telegram_id, username, marzban_username, referred_by)
             VALUES (?, ?, ?, ?)
             """,
             (telegram_id, username, marzban_username, referred_by)
         )
-        await self._connection.commit()
+        self._invalidate_user(telegram_id)
+
+    def _invalidate_user(self, telegram_id: int):
+        """Drop cached lookups for a user after it changes"""
+        self._user_cache.pop(telegram_id, None)
+        self._banned_cache.pop(telegram_id, None)
+
+    def _cache_put(self, cache: OrderedDict, key: int, value: Any):
+        """Store a timestamped value, evicting the oldest entries past CACHE_MAX_ENTRIES"""
+        cache[key] = (time.monotonic(), value)
+        cache.move_to_end(key)
+        while len(cache) > self.CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
 
     async def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
         """Get user by telegram ID"""
-        cursor = await self._connection.execute(
-            "SELECT * FROM users WHERE telegram_id = ?",
-            (telegram_id,)
-        )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        cached = self._user_cache.get(telegram_id)
+        if cached and time.monotonic() - cached[0] < self.USER_CACHE_TTL:
+            return cached[1]
+
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(_SQL_GET_USER, (telegram_id,))
+            row = await cursor.fetchone()
+        user = dict(row) if row else None
+        self._cache_put(self._user_cache, telegram_id, user)
+        return user
 
     async def get_user_by_marzban_username(self, marzban_username: str) -> Optional[Dict[str, Any]]:
         """Get user by Marzban username"""
-        cursor = await self._connection.execute(
-            "SELECT * FROM users WHERE marzban_username = ?",
-            (marzban_username,)
-        )
-        row = await cursor.fetchone()
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                "SELECT * FROM users WHERE marzban_username = ?",
+                (marzban_username,)
+            )
+            row = await cursor.fetchone()
+        return dict(row) if row else None
+
+    async def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        """Get user by Telegram username"""
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                "SELECT * FROM users WHERE username = ? LIMIT 1",
+                (username,)
+            )
+            row = await cursor.fetchone()
         return dict(row) if row else None
 
     async def ban_user(self, telegram_id: int):
         """Ban a user"""
-        await self._connection.execute(
+        await self._write(
             "UPDATE users SET is_banned = 1 WHERE telegram_id = ?",
             (telegram_id,)
         )
-        await self._connection.commit()
+        self._invalidate_user(telegram_id)
 
     async def unban_user(self, telegram_id: int):
         """Unban a user"""
-        await self._connection.execute(
+        await self._write(
             "UPDATE users SET is_banned = 0 WHERE telegram_id = ?",
             (telegram_id,)
         )
-        await self._connection.commit()
+        self._invalidate_user(telegram_id)
 
     async def is_user_banned(self, telegram_id: int) -> bool:
         """Check if user is banned"""
-        cursor = await self._connection.execute(
-            "SELECT is_banned FROM users WHERE telegram_id = ?",
-            (telegram_id,)
-        )
-        row = await cursor.fetchone()
-        return bool(row[0]) if row else False
-
-    async def get_all_users(self) -> List[Dict[str, Any]]:
-        """Get all users"""
-        cursor = await self._connection.execute("SELECT * FROM users")
-        return [dict(row) for row in await cursor.fetchall()]
+        cached = self._banned_cache.get(telegram_id)
+        if cached and time.monotonic() - cached[0] < self.USER_CACHE_TTL:
+            return cached[1]
+
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(_SQL_IS_USER_BANNED, (telegram_id,))
+            row = await cursor.fetchone()
+        banned = bool(row[0]) if row else False
+        self._cache_put(self._banned_cache, telegram_id, banned)
+        return banned
+
+    async def get_all_users(self) -> AsyncIterator[aiosqlite.Row]:
+        """Stream all users"""
+        async with self.read_conn() as connection:
+            async with connection.execute("SELECT * FROM users") as cursor:
+                async for row in cursor:
+                    yield row
+
+    async def iter_all_user_ids(self, batch_size: int = 500) -> AsyncIterator[List[int]]:
+        """Yield user IDs in batches, paging by telegram_id so no connection is held between batches"""
+        last_id = None
+        while True:
+            async with self.read_conn() as connection:
+                if last_id is None:
+                    cursor = await connection.execute(
+                        "SELECT telegram_id FROM users ORDER BY telegram_id LIMIT ?",
+                        (batch_size,)
+                    )
+                else:
+                    cursor = await connection.execute(
+                        "SELECT telegram_id FROM users WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?",
+                        (last_id, batch_size)
+                    )
+                rows = await cursor.fetchall()
+
+            if not rows:
+                return
+            batch = [row[0] for row in rows]
+            yield batch
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1]
 
     async def get_user_count(self) -> int:
         """Get total user count"""
-        cursor = await self._connection.execute("SELECT COUNT(*) FROM users")
-        row = await cursor.fetchone()
+        async with self.read_conn() as connection:
+            cursor = await connection.execute("SELECT COUNT(*) FROM users")
+            row = await cursor.fetchone()
         return row[0]
 
     async def get_banned_users_count(self) -> int:
         """Get banned users count"""
-        cursor = await self._connection.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
-        row = await cursor.fetchone()
+        async with self.read_conn() as connection:
+            cursor = await connection.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
+            row = await cursor.fetchone()
         return row[0]
 
     # Subscription Methods
@@ -179,80 +473,124 @@ class Database:
         is_trial: bool = False
     ):
         """Add a new subscription"""
-        await self._connection.execute(
-            """
-            INSERT INTO subscriptions 
-            (telegram_id, tariff_id, expires_at, traffic_limit_gb, is_trial)
-            VALUES (?, ?, ?, ?, ?)
-            """,
+        # Goes through the writer so activation bursts share one commit
+        await self._write(
+            _SQL_ADD_SUBSCRIPTION,
             (telegram_id, tariff_id, expires_at, traffic_limit_gb, 1 if is_trial else 0)
         )
-        await self._connection.commit()
-
-    async def get_active_subscription(self, telegram_id: int) -> Optional[Dict[str, Any]]:
-        """Get active subscription for a user"""
-        cursor = await self._connection.execute(
-            """
-            SELECT * FROM subscriptions 
-            WHERE telegram_id = ? AND status = 'active' AND expires_at > CURRENT_TIMESTAMP
-            ORDER BY expires_at DESC
-            LIMIT 1
-            """,
-            (telegram_id,)
-        )
-        row = await cursor.fetchone()
-        return dict(row) if row else None
+        self._subscription_cache.pop(telegram_id, None)
+
+    async def get_active_subscription(self, telegram_id: int, use_cache: bool = True) -> Optional[Subscription]:
+        """Get active subscription for a user; pass use_cache=False on write paths"""
+        cached = self._subscription_cache.get(telegram_id) if use_cache else None
+        if cached and time.monotonic() - cached[0] < self.SUBSCRIPTION_CACHE_TTL:
+            return cached[1]
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(_SQL_GET_ACTIVE_SUBSCRIPTION, (telegram_id,))
+            row = await cursor.fetchone()
+        subscription = Subscription._make(row) if row else None
+        self._cache_put(self._subscription_cache, telegram_id, subscription)
+        return subscription
 
     async def update_subscription_status(self, subscription_id: int, status: str):
         """Update subscription status"""
-        await self._connection.execute(
-            "UPDATE subscriptions SET status = ? WHERE id = ?",
-            (status, subscription_id)
+        await self._write(_SQL_UPDATE_SUBSCRIPTION_STATUS, (status, subscription_id))
+        # Writes by subscription id don't know the owner, so drop every cached entry
+        self._subscription_cache.clear()
+
+    async def set_notified_bucket(self, subscription_id: int, notify_window: int):
+        """Remember the smallest notify window a subscription was warned about"""
+        await self._write(
+            "UPDATE subscriptions SET notified_bucket = ? WHERE id = ?",
+            (notify_window, subscription_id)
         )
-        await self._connection.commit()
+        self._subscription_cache.clear()
 
     async def update_subscription_traffic(self, subscription_id: int, traffic_used_gb: float):
         """Update subscription traffic usage"""
-        await self._connection.execute(
+        await self._write(
             "UPDATE subscriptions SET traffic_used_gb = ? WHERE id = ?",
             (traffic_used_gb, subscription_id)
         )
-        await self._connection.commit()
+        self._subscription_cache.clear()
 
-    async def get_expired_subscriptions(self) -> List[Dict[str, Any]]:
-        """Get all expired active subscriptions"""
-        cursor = await self._connection.execute(
-            """
-            SELECT s.*, u.telegram_id, u.marzban_username 
-            FROM subscriptions s
-            JOIN users u ON s.telegram_id = u.telegram_id
-            WHERE s.status = 'active' AND s.expires_at <= CURRENT_TIMESTAMP
-            """
-        )
-        return [dict(row) for row in await cursor.fetchall()]
+    async def update_subscriptions_traffic(self, updates: List[Tuple[int, int]]) -> int:
+        """Batch update traffic usage from (used_traffic_bytes, subscription_id) pairs.
 
-    async def get_expiring_subscriptions(self, hours: int) -> List[Dict[str, Any]]:
-        """Get subscriptions expiring within specified hours"""
-        cursor = await self._connection.execute(
-            """
-            SELECT s.*, u.telegram_id, u.marzban_username 
-            FROM subscriptions s
-            JOIN users u ON s.telegram_id = u.telegram_id
-            WHERE s.status = 'active' 
-            AND s.expires_at <= datetime('now', '+' || ? || ' hours')
-            AND s.expires_at > CURRENT_TIMESTAMP
-            """,
-            (hours,)
+        Rows whose stored value is unchanged are skipped; returns the number of rows written.
+        """
+        cursor = await self._execute_write(
+            _SQL_UPDATE_SUBSCRIPTIONS_TRAFFIC,
+            [(used_bytes, subscription_id, used_bytes) for used_bytes, subscription_id in updates],
+            many=True
         )
-        return [dict(row) for row in await cursor.fetchall()]
+        self._subscription_cache.clear()
+        return cursor.rowcount
+
+    async def get_active_subscriptions_for_sync(self) -> AsyncIterator[aiosqlite.Row]:
+        """Stream active subscriptions with the owner's Marzban username"""
+        async with self.read_conn() as connection:
+            async with connection.execute(
+                """
+                SELECT s.id, s.telegram_id, u.marzban_username
+                FROM subscriptions s
+                JOIN users u ON s.telegram_id = u.telegram_id
+                WHERE s.status = 'active' AND u.marzban_username IS NOT NULL
+                """
+            ) as cursor:
+                async for row in cursor:
+                    yield row
+
+    async def get_expired_subscriptions(self) -> AsyncIterator[aiosqlite.Row]:
+        """Stream expired active subscriptions"""
+        async with self.read_conn() as connection:
+            async with connection.execute(
+                """
+                SELECT s.id, s.telegram_id, s.tariff_id, s.expires_at, u.marzban_username
+                FROM subscriptions s
+                JOIN users u ON s.telegram_id = u.telegram_id
+                WHERE s.status = 'active' AND s.expires_at <= CURRENT_TIMESTAMP
+                """
+            ) as cursor:
+                async for row in cursor:
+                    yield row
+
+    async def get_expiring_subscriptions(self, notify_hours: List[int]) -> AsyncIterator[aiosqlite.Row]:
+        """Stream subscriptions expiring within the largest window, labelled with the smallest matching one.
+
+        Subscriptions already notified for that window (or a smaller one) are skipped.
+        """
+        windows = sorted(notify_hours)
+        window_case = " ".join(
+            "WHEN s.expires_at <= datetime('now', ?) THEN ?" for _ in windows
+        )
+        params = [value for hours in windows for value in (f"+{hours} hours", hours)]
+        params.append(f"+{windows[-1]} hours")
+
+        async with self.read_conn() as connection:
+            async with connection.execute(
+                f"""
+                SELECT s.id, s.telegram_id, s.traffic_limit_gb,
+                       s.traffic_used_gb, u.marzban_username,
+                       CAST((julianday(s.expires_at) - julianday('now')) * 24 AS INTEGER) AS hours_total,
+                       CASE {window_case} END AS notify_window
+                FROM subscriptions s
+                JOIN users u ON s.telegram_id = u.telegram_id
+                WHERE s.status = 'active'
+                AND s.expires_at <= datetime('now', ?)
+                AND s.expires_at > CURRENT_TIMESTAMP
+                AND (s.notified_bucket IS NULL OR s.notified_bucket > notify_window)
+                """,
+                params
+            ) as cursor:
+                async for row in cursor:
+                    yield row
 
     async def has_used_trial(self, telegram_id: int) -> bool:
         """Check if user has already used trial"""
-        cursor = await self._connection.execute(
-            "SELECT COUNT(*) FROM subscriptions WHERE telegram_id = ? AND is_trial = 1",
-            (telegram_id,)
-        )
-        row = await cursor.fetchone()
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(_SQL_HAS_USED_TRIAL, (telegram_id,))
+            row = await cursor.fetchone()
         return row[0] > 0
 
     # Payment Methods
@@ -265,41 +603,69 @@ class Database:
         payment_comment: str
     ) -> int:
         """Add a new payment"""
-        cursor = await self._connection.execute(
+        cursor = await self._execute_write(
             """
             INSERT INTO payments (telegram_id, amount, tariff_id, payment_comment)
             VALUES (?, ?, ?, ?)
             """,
             (telegram_id, amount, tariff_id, payment_comment)
         )
-        await self._connection.commit()
         return cursor.lastrowid
 
     async def get_payment(self, payment_id: int) -> Optional[Dict[str, Any]]:
         """Get payment by ID"""
-        cursor = await self._connection.execute(
-            "SELECT * FROM payments WHERE id = ?",
-            (payment_id,)
-        )
-        row = await cursor.fetchone()
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                "SELECT * FROM payments WHERE id = ?",
+                (payment_id,)
+            )
+            row = await cursor.fetchone()
         return dict(row) if row else None
 
-    async def get_pending_payments(self) -> List[Dict[str, Any]]:
-        """Get all pending payments"""
-        cursor = await self._connection.execute(
-            """
-            SELECT p.*, u.username as tg_username 
-            FROM payments p
-            JOIN users u ON p.telegram_id = u.telegram_id
-            WHERE p.status = 'pending'
-            ORDER BY p.created_at DESC
-            """
-        )
-        return [dict(row) for row in await cursor.fetchall()]
+    async def get_payment_with_user(self, payment_id: int) -> Optional[Dict[str, Any]]:
+        """Get payment by ID together with the payer's usernames"""
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT p.*, u.username AS u_username, u.marzban_username AS u_marzban
+                FROM payments p
+                LEFT JOIN users u ON u.telegram_id = p.telegram_id
+                WHERE p.id = ?
+                """,
+                (payment_id,)
+            )
+            row = await cursor.fetchone()
+        return dict(row) if row else None
+
+    async def get_pending_payments(self, limit: int = -1, offset: int = 0) -> List[aiosqlite.Row]:
+        """Get a page of pending payments, newest first (limit -1 returns all)"""
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT p.id, p.telegram_id, p.amount, p.tariff_id, p.payment_comment,
+                       p.created_at, u.username as tg_username
+                FROM payments p
+                JOIN users u ON p.telegram_id = u.telegram_id
+                WHERE p.status = 'pending'
+                ORDER BY p.created_at DESC
+                LIMIT ? OFFSET ?
+                """,
+                (limit, offset)
+            )
+            return await cursor.fetchall()
+
+    async def count_pending_payments(self) -> int:
+        """Get pending payments count"""
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                "SELECT COUNT(*) FROM payments WHERE status = 'pending'"
+            )
+            row = await cursor.fetchone()
+        return row[0]
 
     async def approve_payment(self, payment_id: int, reviewed_by: int):
         """Approve a payment"""
-        await self._connection.execute(
+        await self._execute_write(
             """
             UPDATE payments 
             SET status = 'approved', reviewed_at = CURRENT_TIMESTAMP, reviewed_by = ?
@@ -307,11 +673,10 @@ class Database:
             """,
             (reviewed_by, payment_id)
         )
-        await self._connection.commit()
 
     async def reject_payment(self, payment_id: int, reviewed_by: int):
         """Reject a payment"""
-        await self._connection.execute(
+        await self._execute_write(
             """
             UPDATE payments 
             SET status = 'rejected', reviewed_at = CURRENT_TIMESTAMP, reviewed_by = ?
@@ -319,61 +684,115 @@ class Database:
             """,
             (reviewed_by, payment_id)
         )
-        await self._connection.commit()
+
+    async def delete_old_payments(self, cutoff: datetime) -> int:
+        """Delete reviewed payments older than cutoff, returns how many were removed"""
+        cursor = await self._execute_write(
+            """
+            DELETE FROM payments
+            WHERE status IN ('approved', 'rejected')
+            AND reviewed_at < ?
+            """,
+            # Same format as CURRENT_TIMESTAMP so the string comparison is exact
+            (cutoff.strftime("%Y-%m-%d %H:%M:%S"),)
+        )
+        return cursor.rowcount
 
     # Referral Methods
 
     async def add_referral(self, referrer_id: int, referred_id: int, bonus_days: int = 0):
         """Add a referral record"""
-        await self._connection.execute(
+        await self._execute_write(
             """
             INSERT OR IGNORE INTO referrals (referrer_id, referred_id, bonus_days)
             VALUES (?, ?, ?)
             """,
             (referrer_id, referred_id, bonus_days)
         )
-        await self._connection.commit()
 
     async def get_referral_count(self, referrer_id: int) -> int:
         """Get number of referrals for a user"""
-        cursor = await self._connection.execute(
-            "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
-            (referrer_id,)
-        )
-        row = await cursor.fetchone()
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                "SELECT COUNT(*) FROM referrals WHERE referrer_id = ?",
+                (referrer_id,)
+            )
+            row = await cursor.fetchone()
         return row[0]
 
     async def get_referrer(self, referred_id: int) -> Optional[int]:
         """Get referrer for a user"""
-        cursor = await self._connection.execute(
-            "SELECT referrer_id FROM referrals WHERE referred_id = ?",
-            (referred_id,)
-        )
-        row = await cursor.fetchone()
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                "SELECT referrer_id FROM referrals WHERE referred_id = ?",
+                (referred_id,)
+            )
+            row = await cursor.fetchone()
         return row[0] if row else None
 
+    async def get_user_overview(
+        self,
+        telegram_id: int
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[Subscription], int]:
+        """Get user, active subscription and referral count in one query"""
+        async with self.read_conn() as connection:
+            cursor = await connection.execute(
+                """
+                SELECT u.*,
+                       s.id AS s_id, s.telegram_id AS s_telegram_id, s.tariff_id AS s_tariff_id,
+                       s.status AS s_status, s.created_at AS s_created_at,
+                       s.expires_at AS s_expires_at, s.traffic_limit_gb AS s_traffic_limit_gb,
+                       s.traffic_used_gb AS s_traffic_used_gb, s.is_trial AS s_is_trial,
+                       s.notified_bucket AS s_notified_bucket,
+                       (SELECT COUNT(*) FROM referrals r
+                        WHERE r.referrer_id = u.telegram_id) AS referral_count
+                FROM users u
+                LEFT JOIN subscriptions s ON s.id = (
+                    SELECT id FROM subscriptions
+                    WHERE telegram_id = u.telegram_id AND status = 'active'
+                    AND expires_at > CURRENT_TIMESTAMP
+                    ORDER BY expires_at DESC
+                    LIMIT 1
+                )
+                WHERE u.telegram_id = ?
+                """,
+                (telegram_id,)
+            )
+            row = await cursor.fetchone()
+
+        if not row:
+            return None, None, 0
+
+        row = dict(row)
+        referral_count = row.pop("referral_count")
+        # Split the s_-prefixed columns back into a subscription row
+        subscription = Subscription._make(row.pop(f"s_{field}") for field in Subscription._fields)
+        return row, subscription if subscription.id is not None else None, referral_count
+
     # Statistics Methods
 
     async def get_statistics(self) -> Dict[str, Any]:
         """Get bot statistics"""
-        stats = {}
-        
-        # User counts
-        stats['total_users'] = await self.get_user_count()
-        stats['banned_users'] = await self.get_banned_users_count()
-        
-        # Active subscriptions
-        cursor = await self._connection.execute(
-            "SELECT COUNT(*) FROM subscriptions WHERE status = 'active' AND expires_at > CURRENT_TIMESTAMP"
+        # Full-table counts run on the maintenance connection, off the hot read pool
+        cursor = await self._maint_conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(is_banned), 0) FROM users"
         )
-        row = await cursor.fetchone()
-        stats['active_subscriptions'] = row[0]
-        
-        # Pending payments
-        cursor = await self._connection.execute(
-            "SELECT COUNT(*) FROM payments WHERE status = 'pending'"
+        total_users, banned_users = await cursor.fetchone()
+
+        # Active subscriptions and pending payments
+        cursor = await self._maint_conn.execute(
+            """
+            SELECT
+                (SELECT COUNT(*) FROM subscriptions
+                 WHERE status = 'active' AND expires_at > CURRENT_TIMESTAMP),
+                (SELECT COUNT(*) FROM payments WHERE status = 'pending')
+            """
         )
-        row = await cursor.fetchone()
-        stats['pending_payments'] = row[0]
-        
-        return stats
+        active_subscriptions, pending_payments = await cursor.fetchone()
+
+        return {
+            'total_users': total_users,
+            'banned_users': banned_users,
+            'active_subscriptions': active_subscriptions,
+            'pending_payments': pending_payments
+        }
@@ -1 +1,2 @@
 _marzban_client = None
+_bot_username = None
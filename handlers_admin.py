@@ -1,18 +1,17 @@
 """
-    marzban_client = globals._marzban_client
-    marzban_client = globals._marzban_client
-    marzban_client = globals._marzban_client
-    marzban_client = globals._marzban_client
 Admin Handlers Module
 Handles all admin panel commands and callbacks
 """
 
+import asyncio
+import html
 import logging
-from datetime import datetime
+import time
+from datetime import datetime, timezone
 from aiogram import Router, F, types
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.types import LabeledPrice
 
 from database import Database
 from marzban_client import MarzbanClient
@@ -27,6 +26,8 @@ from keyboards import (
     get_broadcast_keyboard,
 )
 from states import AdminStates, PaymentStates
+from tariffs import get_tariff
+from throttling import TelegramLimiter
 import globals
 
 
@@ -34,25 +35,57 @@ logger = logging.getLogger(__name__)
 
 admin_router = Router()
 
+# Concurrent sends during a broadcast, kept under Telegram's ~30 msg/s limit
+BROADCAST_CONCURRENCY = 25
+# Users loaded into memory per broadcast slice
+BROADCAST_CHUNK_SIZE = 500
+# Slices between progress updates of the broadcast status message
+BROADCAST_PROGRESS_EVERY = 4
+# Pending payments shown in the admin list
+PAYMENTS_PAGE_SIZE = 10
+
+# Marzban calls from admin actions: per-call timeout, and after this many
+# consecutive failures skip Marzban for the cooldown period
+MARZBAN_CALL_TIMEOUT = 3.0
+MARZBAN_BREAKER_THRESHOLD = 3
+MARZBAN_BREAKER_COOLDOWN = 30
+_MZ_BREAKER = {"fail_until": 0.0, "consecutive": 0}
+
+# Static texts
+_ADMIN_MENU_TEXT = "👑 Админ Панель\n\nВыберите действие:"
+_USERS_MENU_TEXT = "👥 Управление пользователями\n\nВыберите действие:"
+_SEARCH_ID_PROMPT = "🔍 Введите Telegram ID пользователя:"
+_SEARCH_USERNAME_PROMPT = "🔍 Введите username пользователя (без @):"
+_BROADCAST_PROMPT = (
+    "📢 Рассылка\n\n"
+    "Отправьте сообщение, которое хотите разослать всем пользователям.\n\n"
+    "Поддерживается текст, фото, видео и другие медиа."
+)
+
 
-async def is_admin(telegram_id: int, config: dict) -> bool:
+async def _safe_edit(message: types.Message, text: str, **kwargs):
+    """Edit a message unless it already shows the same text and keyboard"""
+    if message.text == text and message.reply_markup == kwargs.get("reply_markup"):
+        return
+    try:
+        await message.edit_text(text, **kwargs)
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            raise
+
+
+def is_admin(telegram_id: int, config: dict) -> bool:
     """Check if user is admin"""
-    admin_ids = config.ADMIN_USER_IDS
-    return str(telegram_id) in admin_ids
+    return telegram_id in config.ADMIN_USER_IDS
 
 
 @admin_router.message(Command("admin"))
 async def cmd_admin(message: types.Message, config: dict, db: Database):
     """Open admin panel"""
-    if not await is_admin(message.from_user.id, config):
+    if not is_admin(message.from_user.id, config):
         return
     
-    text = (
-        "👑 Админ Панель\n\n"
-        "Выберите действие:"
-    )
-    
-    await message.answer(text, reply_markup=get_admin_keyboard())
+    await message.answer(_ADMIN_MENU_TEXT, reply_markup=get_admin_keyboard())
 
 
 @admin_router.callback_query(F.data == "admin_stats")
@@ -65,13 +98,13 @@ async def admin_statistics(callback: types.CallbackQuery, db: Database):
         
         # Get Marzban system stats
         try:
-            marzban_stats = await globals._marzban_client.get_system_stats()
+            marzban_stats = await marzban_client.get_system_stats()
             marzban_text = (
                 f"\n🖥 Marzban Статистика:\n"
                 f"👥 Пользователей: {marzban_stats.get('total_user', 0)}\n"
                 f"✅ Активных: {marzban_stats.get('active_users', 0)}\n"
-                f"💾 Использовано: {globals._marzban_client.format_traffic(marzban_stats.get('users_used', 0))}\n"
-                f"🌐 Всего: {globals._marzban_client.format_traffic(marzban_stats.get('users_total', 0))}\n"
+                f"💾 Использовано: {marzban_client.format_traffic(marzban_stats.get('users_used', 0))}\n"
+                f"🌐 Всего: {marzban_client.format_traffic(marzban_stats.get('users_total', 0))}\n"
             )
         except Exception as e:
             logger.error(f"Failed to get Marzban stats: {e}")
@@ -97,22 +130,25 @@ async def admin_statistics(callback: types.CallbackQuery, db: Database):
 @admin_router.callback_query(F.data == "admin_payments")
 async def admin_payments(callback: types.CallbackQuery, db: Database):
     """Show pending payments"""
-    payments = await db.get_pending_payments()
+    payments, total = await asyncio.gather(
+        db.get_pending_payments(limit=PAYMENTS_PAGE_SIZE),
+        db.count_pending_payments()
+    )
     
     if not payments:
         text = "💰 Платежи\n\n✅ Нет ожидающих платежей"
         await callback.message.edit_text(text, reply_markup=get_back_keyboard())
     else:
-        text = f"💰 Ожидают оплаты ({len(payments)}):\n\n"
-        for payment in payments[:10]:
-            text += (
-                f"ID: {payment['id']}\n"
-                f"👤 @{payment.get('tg_username', 'user')}\n"
-                f"💵 {payment['amount']}₽\n"
-                f"📦 {payment['tariff_id']}\n"
-                f"🔢 {payment['payment_comment']}\n"
-                f"⏰ {payment['created_at']}\n\n"
-            )
+        rows = [
+            f"ID: {payment['id']}\n"
+            f"👤 @{payment['tg_username']}\n"
+            f"💵 {payment['amount']}₽\n"
+            f"📦 {payment['tariff_id']}\n"
+            f"🔢 {payment['payment_comment']}\n"
+            f"⏰ {payment['created_at']}"
+            for payment in payments
+        ]
+        text = f"💰 Ожидают оплаты ({total}):\n\n" + "\n\n".join(rows)
         
         await callback.message.edit_text(
             text,
@@ -125,23 +161,21 @@ async def admin_payments(callback: types.CallbackQuery, db: Database):
 @admin_router.callback_query(F.data.startswith("payment_view_"))
 async def admin_view_payment(callback: types.CallbackQuery, db: Database):
     """View payment details"""
-    payment_id = int(callback.data.replace("payment_view_", ""))
-    payment = await db.get_payment(payment_id)
+    payment_id = int(callback.data.removeprefix("payment_view_"))
+    payment = await db.get_payment_with_user(payment_id)
     
     if not payment:
         await callback.answer("❌ Платеж не найден", show_alert=True)
         return
     
-    user = await db.get_user(payment["telegram_id"])
-    
     text = (
         f"💰 Детали платежа\n\n"
         f"ID: {payment['id']}\n"
-        f"👤 Пользователь: @{user['username'] if user else 'unknown'}\n"
-        f"🆔 Telegram ID: `{payment['telegram_id']}`\n"
+        f"👤 Пользователь: @{html.escape(payment['u_username'] or 'unknown')}\n"
+        f"🆔 Telegram ID: <code>{payment['telegram_id']}</code>\n"
         f"💵 Сумма: {payment['amount']}₽\n"
         f"📦 Тариф: {payment['tariff_id']}\n"
-        f"🔢 Комментарий: `{payment['payment_comment']}`\n"
+        f"🔢 Комментарий: <code>{html.escape(payment['payment_comment'] or '')}</code>\n"
         f"📅 Создан: {payment['created_at']}\n"
         f"⏳ Статус: {payment['status']}\n"
     )
@@ -149,8 +183,7 @@ async def admin_view_payment(callback: types.CallbackQuery, db: Database):
     if payment["status"] == "pending":
         await callback.message.edit_text(
             text,
-            reply_markup=get_payment_review_keyboard(payment_id),
-            parse_mode="Markdown"
+            reply_markup=get_payment_review_keyboard(payment_id)
         )
     else:
         await callback.message.edit_text(text, reply_markup=get_back_keyboard())
@@ -162,59 +195,57 @@ async def admin_view_payment(callback: types.CallbackQuery, db: Database):
 async def admin_approve_payment(callback: types.CallbackQuery, db: Database):
     """Approve payment"""
     marzban_client = globals._marzban_client
-    payment_id = int(callback.data.replace("admin_approve_", ""))
+    payment_id = int(callback.data.removeprefix("admin_approve_"))
     payment = await db.get_payment(payment_id)
     
     if not payment:
         await callback.answer("❌ Платеж не найден", show_alert=True)
         return
     
-    # Approve payment
-    await db.approve_payment(payment_id, callback.from_user.id)
+    # Load the user and their current subscription together; the subscription
+    # is read uncached since it decides whether to extend or create
+    user, existing_sub = await asyncio.gather(
+        db.get_user(payment["telegram_id"]),
+        db.get_active_subscription(payment["telegram_id"], use_cache=False)
+    )
     
     # Get tariff info
-    with open("data/tarifs.json", "r", encoding="utf-8") as f:
-        import json
-        data = json.load(f)
-    tariff = next((t for t in data["tariffs"] if t["id"] == payment["tariff_id"]), None)
+    tariff = get_tariff(payment["tariff_id"])
     
     if not tariff:
         await callback.answer("❌ Тариф не найден", show_alert=True)
         return
     
-    # Get or create user in Marzban
-    user = await db.get_user(payment["telegram_id"])
     if not user:
         await callback.answer("❌ Пользователь не найден", show_alert=True)
         return
     
-    # Check if user already has subscription
-    existing_sub = await db.get_active_subscription(payment["telegram_id"])
+    # Only mark the payment approved once it can actually be fulfilled
+    await db.approve_payment(payment_id, callback.from_user.id)
+    
+    expire = marzban_client.calculate_expire_timestamp(tariff["duration_days"])
     
     try:
         if existing_sub:
             # Extend existing subscription
-            marzban_user = await globals._marzban_client.get_user(user["marzban_username"])
-            new_expire = globals._marzban_client.calculate_expire_timestamp(
-                tariff["duration_days"]
-            )
+            marzban_user = await marzban_client.get_user(user["marzban_username"])
             new_traffic = marzban_user.get("data_limit", 0) + (tariff.get('traffic_gb', 0) * 1024 * 1024 * 1024)
             
-            await globals._marzban_client.modify_user(
+            await marzban_client.modify_user(
                 user["marzban_username"],
                 data_limit=new_traffic,
-                expire=new_expire
+                expire=expire
             )
         else:
             # Create new user
-            await globals._marzban_client.create_user(
+            await marzban_client.create_user(
                 username=user["marzban_username"],
                 data_limit=tariff.get('traffic_gb', 0) * 1024 * 1024 * 1024,
-                expire=globals._marzban_client.calculate_expire_timestamp(tariff["duration_days"])
+                expire=expire
             )
         
         # Add subscription to database
-        expires_at = datetime.utcnow() + timedelta(days=tariff["duration_days"])
+        expires_at = datetime.fromtimestamp(expire, tz=timezone.utc)
         await db.add_subscription(
             telegram_id=payment["telegram_id"],
             tariff_id=tariff["id"],
@@ -223,7 +254,7 @@ async def admin_approve_payment(callback: types.CallbackQuery, db: Database):
         )
         
         # Notify user
-        sub_link = globals._marzban_client.get_subscription_link(user["marzban_username"])
+        sub_link = marzban_client.get_subscription_link(user["marzban_username"])
         try:
             await callback.bot.send_message(
                 payment["telegram_id"],
@@ -231,8 +262,7 @@ async def admin_approve_payment(callback: types.CallbackQuery, db: Database):
                 f"📦 Тариф: {tariff['name']}\n"
                 f"⏳ Срок: {tariff['duration_days']} дн.\n"
                 f"📊 Трафик: {tariff.get('traffic_gb', 0)} GB\n\n"
-                f"🔗 Ссылка: `{sub_link}`",
-                parse_mode="Markdown"
+                f"🔗 Ссылка: <code>{html.escape(sub_link)}</code>"
             )
         except Exception as e:
             logger.error(f"Failed to notify user: {e}")
@@ -254,7 +284,7 @@ async def admin_approve_payment(callback: types.CallbackQuery, db: Database):
 @admin_router.callback_query(F.data.startswith("admin_reject_"))
 async def admin_reject_payment(callback: types.CallbackQuery, db: Database):
     """Reject payment"""
-    payment_id = int(callback.data.replace("admin_reject_", ""))
+    payment_id = int(callback.data.removeprefix("admin_reject_"))
     payment = await db.get_payment(payment_id)
     
     if not payment:
@@ -286,13 +316,9 @@ async def admin_reject_payment(callback: types.CallbackQuery, db: Database):
 @admin_router.callback_query(F.data == "admin_users")
 async def admin_users(callback: types.CallbackQuery, db: Database):
     """Show users management"""
-    text = (
-        "👥 Управление пользователями\n\n"
-        "Выберите действие:"
-    )
-    
-    await callback.message.edit_text(
-        text,
+    await _safe_edit(
+        callback.message,
+        _USERS_MENU_TEXT,
         reply_markup=get_user_search_keyboard()
     )
     await callback.answer()
@@ -301,8 +327,9 @@ async def admin_users(callback: types.CallbackQuery, db: Database):
 @admin_router.callback_query(F.data == "search_by_id")
 async def search_by_id(callback: types.CallbackQuery, state: FSMContext):
     """Search user by ID"""
-    await callback.message.edit_text(
-        "🔍 Введите Telegram ID пользователя:",
+    await _safe_edit(
+        callback.message,
+        _SEARCH_ID_PROMPT,
         reply_markup=get_back_keyboard()
     )
     await state.set_state(AdminStates.search_input)
@@ -313,8 +340,9 @@ async def search_by_id(callback: types.CallbackQuery, state: FSMContext):
 @admin_router.callback_query(F.data == "search_by_username")
 async def search_by_username(callback: types.CallbackQuery, state: FSMContext):
     """Search user by username"""
-    await callback.message.edit_text(
-        "🔍 Введите username пользователя (без @):",
+    await _safe_edit(
+        callback.message,
+        _SEARCH_USERNAME_PROMPT,
         reply_markup=get_back_keyboard()
     )
     await state.set_state(AdminStates.search_input)
@@ -337,9 +365,8 @@ async def process_search(message: types.Message, state: FSMContext, db: Database
             await message.answer("❌ Неверный формат ID")
             return
     else:
-        # Search by username - need to iterate all users
-        all_users = await db.get_all_users()
-        user = next((u for u in all_users if u["username"] == search_value.lstrip("@")), None)
+        # Search by username
+        user = await db.get_user_by_username(search_value.lstrip("@"))
     
     if not user:
         await message.answer("❌ Пользователь не найден", reply_markup=get_back_keyboard())
@@ -350,20 +377,19 @@ async def process_search(message: types.Message, state: FSMContext, db: Database
     
     text = (
         f"👤 Пользователь\n\n"
-        f"ID: `{user['telegram_id']}`\n"
-        f"Username: @{user['username']}\n"
-        f"Marzban: `{user['marzban_username']}`\n"
+        f"ID: <code>{user['telegram_id']}</code>\n"
+        f"Username: @{html.escape(user['username'] or '')}\n"
+        f"Marzban: <code>{user['marzban_username']}</code>\n"
         f"📅 Регистрация: {user['created_at']}\n"
         f"🔑 Подписка: {'✅ Активна' if subscription else '❌ Не активна'}\n"
     )
     
     if subscription:
-        text += f"⏳ Истекает: {subscription['expires_at']}"
+        text += f"⏳ Истекает: {subscription.expires_at}"
     
     await message.answer(
         text,
-        reply_markup=get_user_management_keyboard(user["telegram_id"]),
-        parse_mode="Markdown"
+        reply_markup=get_user_management_keyboard(user["telegram_id"])
     )
     
     await state.clear()
@@ -372,7 +398,8 @@ async def process_search(message: types.Message, state: FSMContext, db: Database
 @admin_router.callback_query(F.data.startswith("admin_user_info_"))
 async def admin_user_info(callback: types.CallbackQuery, db: Database):
     """Show detailed user info"""
-    telegram_id = int(callback.data.replace("admin_user_info_", ""))
+    marzban_client = globals._marzban_client
+    telegram_id = int(callback.data.removeprefix("admin_user_info_"))
     user = await db.get_user(telegram_id)
     
     if not user:
@@ -381,20 +408,20 @@ async def admin_user_info(callback: types.CallbackQuery, db: Database):
     
     # Get info from Marzban
     try:
-        marzban_user = await globals._marzban_client.get_user(user["marzban_username"])
-        traffic_used = globals._marzban_client.format_traffic(marzban_user.get("used_traffic", 0))
-        traffic_limit = globals._marzban_client.format_traffic(marzban_user.get("data_limit", 0))
+        marzban_user = await marzban_client.get_user(user["marzban_username"])
+        traffic_used = marzban_client.format_traffic(marzban_user.get("used_traffic", 0))
+        traffic_limit = marzban_client.format_traffic(marzban_user.get("data_limit", 0))
         status = marzban_user.get("status", "unknown")
-        expire_date = datetime.fromtimestamp(marzban_user.get("expire", 0)) if marzban_user.get("expire") else "Never"
+        expire_date = datetime.fromtimestamp(marzban_user.get("expire", 0), tz=timezone.utc) if marzban_user.get("expire") else "Never"
     except Exception as e:
         logger.error(f"Failed to get Marzban user info: {e}")
         marzban_user = None
     
     text = (
         f"📊 Информация о пользователе\n\n"
-        f"Telegram: @{user['username']}\n"
-        f"ID: `{user['telegram_id']}`\n"
-        f"Marzban: `{user['marzban_username']}`\n"
+        f"Telegram: @{html.escape(user['username'] or '')}\n"
+        f"ID: <code>{user['telegram_id']}</code>\n"
+        f"Marzban: <code>{user['marzban_username']}</code>\n"
     )
     
     if marzban_user:
@@ -405,7 +432,7 @@ async def admin_user_info(callback: types.CallbackQuery, db: Database):
             f"Истекает: {expire_date}\n"
         )
     
-    await callback.message.answer(text, parse_mode="Markdown", reply_markup=get_back_keyboard())
+    await callback.message.answer(text, reply_markup=get_back_keyboard())
     await callback.answer()
 
 
@@ -413,7 +440,7 @@ async def admin_user_info(callback: types.CallbackQuery, db: Database):
 async def admin_user_ban(callback: types.CallbackQuery, db: Database):
     """Ban user"""
     marzban_client = globals._marzban_client
-    telegram_id = int(callback.data.replace("admin_user_ban_", ""))
+    telegram_id = int(callback.data.removeprefix("admin_user_ban_"))
     user = await db.get_user(telegram_id)
     
     if not user:
@@ -430,11 +457,21 @@ async def admin_user_ban(callback: types.CallbackQuery, db: Database):
     else:
         # Ban
         await db.ban_user(telegram_id)
-        # Disable user in Marzban
-        try:
-            await globals._marzban_client.modify_user(user["marzban_username"], status="disabled")
-        except Exception as e:
-            logger.error(f"Failed to disable Marzban user: {e}")
+        # Disable user in Marzban, unless it has been failing recently
+        if time.monotonic() < _MZ_BREAKER["fail_until"]:
+            logger.error(f"Marzban unavailable, skipped disabling {user['marzban_username']}")
+        else:
+            try:
+                await asyncio.wait_for(
+                    marzban_client.modify_user(user["marzban_username"], status="disabled"),
+                    timeout=MARZBAN_CALL_TIMEOUT
+                )
+                _MZ_BREAKER["consecutive"] = 0
+            except Exception as e:
+                logger.error(f"Failed to disable Marzban user: {e}")
+                _MZ_BREAKER["consecutive"] += 1
+                if _MZ_BREAKER["consecutive"] >= MARZBAN_BREAKER_THRESHOLD:
+                    _MZ_BREAKER["fail_until"] = time.monotonic() + MARZBAN_BREAKER_COOLDOWN
         text = f"🚫 Пользователь @{user['username']} забанен"
     
     await callback.message.answer(text, reply_markup=get_back_keyboard())
@@ -444,10 +481,9 @@ async def admin_user_ban(callback: types.CallbackQuery, db: Database):
 @admin_router.callback_query(F.data == "admin_broadcast")
 async def admin_broadcast(callback: types.CallbackQuery, state: FSMContext):
     """Start broadcast message"""
-    await callback.message.edit_text(
-        "📢 Рассылка\n\n"
-        "Отправьте сообщение, которое хотите разослать всем пользователям.\n\n"
-        "Поддерживается текст, фото, видео и другие медиа.",
+    await _safe_edit(
+        callback.message,
+        _BROADCAST_PROMPT,
         reply_markup=get_broadcast_keyboard()
     )
     await state.set_state(AdminStates.broadcast_message)
@@ -455,34 +491,60 @@ async def admin_broadcast(callback: types.CallbackQuery, state: FSMContext):
 
 
 @admin_router.message(AdminStates.broadcast_message)
-async def process_broadcast(message: types.Message, state: FSMContext, db: Database):
+async def process_broadcast(
+    message: types.Message,
+    state: FSMContext,
+    db: Database,
+    limiter: TelegramLimiter
+):
     """Process broadcast message"""
-    users = await db.get_all_users()
-    
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    # Bound once; the per-recipient closure runs for every user
+    copy_message = limiter.copy_message
+    log_error = logger.error
+
+    async def send(telegram_id: int) -> bool:
+        async with semaphore:
+            try:
+                # The shared limiter paces sends and waits out flood control
+                await copy_message(message, telegram_id)
+                return True
+            except Exception as e:
+                log_error(f"Failed to send to {telegram_id}: {e}")
+                return False
+
+    async def send_batch(batch: list) -> int:
+        results = await asyncio.gather(*(send(telegram_id) for telegram_id in batch))
+        return sum(results)
+
     success_count = 0
-    fail_count = 0
-    
-    # Forward message to all users
-    for user in users:
-        try:
-            if message.text:
-                await message.copy_to(user["telegram_id"])
-            elif message.photo:
-                await message.copy_to(user["telegram_id"])
-            elif message.video:
-                await message.copy_to(user["telegram_id"])
-            else:
-                await message.copy_to(user["telegram_id"])
-            success_count += 1
-        except Exception as e:
-            logger.error(f"Failed to send to {user['telegram_id']}: {e}")
-            fail_count += 1
+    total = 0
+    status_message = await message.answer("📢 Рассылка запущена...")
+
+    # Users are paged from the database, so only one batch is in memory at a time
+    batches = 0
+    async for batch in db.iter_all_user_ids(BROADCAST_CHUNK_SIZE):
+        success_count += await send_batch(batch)
+        total += len(batch)
+        batches += 1
+
+        if batches % BROADCAST_PROGRESS_EVERY == 0:
+            try:
+                await status_message.edit_text(
+                    f"📢 Рассылка...\n\n"
+                    f"✅ Успешно: {success_count}\n"
+                    f"❌ Ошибок: {total - success_count}"
+                )
+            except Exception as e:
+                logger.error(f"Failed to update broadcast progress: {e}")
+
+    fail_count = total - success_count
     
     await message.answer(
         f"📢 Рассылка завершена\n\n"
         f"✅ Успешно: {success_count}\n"
         f"❌ Ошибок: {fail_count}\n"
-        f"👥 Всего: {len(users)}",
+        f"👥 Всего: {total}",
         reply_markup=get_back_keyboard()
     )
     
@@ -492,16 +554,12 @@ async def process_broadcast(message: types.Message, state: FSMContext, db: Datab
 @admin_router.callback_query(F.data == "back_to_admin")
 async def back_to_admin(callback: types.CallbackQuery, config: dict):
     """Return to admin menu"""
-    if not await is_admin(callback.from_user.id, config):
+    if not is_admin(callback.from_user.id, config):
         return
     
-    text = (
-        "👑 Админ Панель\n\n"
-        "Выберите действие:"
-    )
-    
-    await callback.message.edit_text(
-        text,
+    await _safe_edit(
+        callback.message,
+        _ADMIN_MENU_TEXT,
         reply_markup=get_admin_keyboard()
     )
     await callback.answer()
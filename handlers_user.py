@@ -1,20 +1,19 @@
 """
-    marzban_client = globals._marzban_client
-    marzban_client = globals._marzban_client
-    marzban_client = globals._marzban_client
 User Handlers Module
 Handles all user-facing bot commands and callbacks
 """
 
+import asyncio
+import html
 import logging
-import json
-import random
-import string
-from datetime import datetime, timedelta
+import secrets
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Optional
+
 from aiogram import Router, F, types
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from database import Database
 from marzban_client import MarzbanClient
@@ -31,6 +30,7 @@ from keyboards import (
     get_back_keyboard,
 )
 from states import TariffStates, PaymentStates
+from tariffs import get_tariff, get_tariffs, get_tariffs_version
 import globals
 
 
@@ -38,6 +38,33 @@ logger = logging.getLogger(__name__)
 
 user_router = Router()
 
+# Static texts; templates are filled with str.format
+_WELCOME_NEW_TMPL = (
+    "👋 Привет, @{u}!\n\n"
+    "🤖 Добро пожаловать в VPN бот!\n\n"
+    "🔐 Быстрый и надежный VPN для ваших нужд\n"
+    "📱 Работает на всех устройствах\n"
+    "⚡ Мгновенная активация\n\n"
+    "Нажмите 🔑 Мой VPN чтобы начать!"
+)
+_WELCOME_RETURN_TMPL = "👋 С возвращением, @{u}!\n\nВыберите действие в меню:"
+_HELP_TEXT = (
+    "ℹ️ Помощь\n\n"
+    "🤖 Этот бот поможет вам купить и управлять VPN подпиской.\n\n"
+    "📋 Команды:\n"
+    "🔑 Мой VPN - управление подпиской\n"
+    "💰 Тарифы - выбрать тариф\n"
+    "📊 Статус - проверить статус\n"
+    "🎁 Рефералы - пригласить друзей\n\n"
+    "❓ Нужна помощь? Свяжитесь с поддержкой."
+)
+_SUPPORT_TMPL = "📞 Поддержка\n\nСвяжитесь с нами: {url}"
+_CHANNEL_TMPL = "📢 Наш канал: {url}"
+_REF_LINK_TMPL = "https://t.me/{u}?start=ref_{tid}"
+
+# Strong references to fire-and-forget notification tasks
+_notify_tasks = set()
+
 
 # Text handlers for ReplyKeyboard buttons (main menu)
 @user_router.message(F.text == "🔑 Мой VPN")
@@ -45,9 +72,8 @@ async def my_vpn_text(message: types.Message, db: Database):
     """Handle VPN button text message"""
     telegram_id = message.from_user.id
     subscription = await db.get_active_subscription(telegram_id)
-    from keyboards import get_my_vpn_keyboard, get_main_keyboard
     if subscription:
-        text = "🔑 Ваш VPN\n\nСтатус: ✅ Активен\nТариф: " + subscription.get('tariff_name', 'N/A')
+        text = "🔑 Ваш VPN\n\nСтатус: ✅ Активен\nТариф: " + subscription.tariff_id
         await message.answer(text, reply_markup=get_my_vpn_keyboard(True))
     else:
         await message.answer("🔑 Мой VPN\n\nУ вас нет активной подписки.", reply_markup=get_main_keyboard())
@@ -58,7 +84,7 @@ async def status_text(message: types.Message, db: Database):
     telegram_id = message.from_user.id
     subscription = await db.get_active_subscription(telegram_id)
     if subscription:
-        text = "📊 Статус\n\n✅ Активен\nТариф: " + subscription.get('tariff_name', 'N/A')
+        text = "📊 Статус\n\n✅ Активен\nТариф: " + subscription.tariff_id
         await message.answer(text)
     else:
         await message.answer("📊 Статус\n\nНет активной подписки")
@@ -66,19 +92,51 @@ async def status_text(message: types.Message, db: Database):
 @user_router.message(F.text == "❓ Помощь")
 async def help_text(message: types.Message):
     """Handle Help button text message"""
-    from keyboards import get_help_keyboard
     await message.answer("❓ Помощь\n\nКак мы можем помочь?", reply_markup=get_help_keyboard())
 
 
 def generate_marzban_username(telegram_id: int) -> str:
     """Generate unique Marzban username"""
-    random_suffix = ''.join(random.choices(string.ascii_lowercase, k=4))
-    return f"user_{telegram_id}_{random_suffix}"
+    return f"user_{telegram_id}_{secrets.token_hex(2)}"
 
 
 def generate_payment_comment() -> str:
     """Generate unique payment comment"""
-    return f"VPN{random.randint(100000, 999999)}"
+    return f"VPN{secrets.randbelow(900000) + 100000}"
+
+
+def _tariff_block(tariff: dict) -> str:
+    """Render one tariff entry of the catalog"""
+    lines = [
+        tariff['name'],
+        f"💵 Цена: {tariff['price']}₽",
+        f"⏳ Срок: {tariff['duration_days']} дн.",
+        f"🔗 Устройств: {tariff['max_ips']}",
+    ]
+    if tariff.get('location'):
+        lines.append(f"🌍 Локация: {tariff['location']}")
+    if tariff.get('is_trial'):
+        lines.append("✅ Пробный период")
+    return "\n".join(lines) + "\n\n"
+
+
+@lru_cache(maxsize=4)
+def _tariffs_text(version: int) -> str:
+    """Render the tariff catalog once per tariffs file version"""
+    return "💰 Доступные тарифы:\n\n" + "".join([_tariff_block(t) for t in get_tariffs()])
+
+
+async def _notify_referrer(bot, db: Database, referrer_id: int, username: Optional[str]):
+    """Tell the referrer that their invitee has registered"""
+    try:
+        if await db.get_user(referrer_id):
+            await bot.send_message(
+                referrer_id,
+                f"🎉 Ваш реферал @{username or 'user'} зарегистрировался!\n"
+                f"Когда он купит подписку, вы получите бонусные дни."
+            )
+    except Exception as e:
+        logger.error(f"Failed to notify referrer: {e}")
 
 
 @user_router.message(Command("start"))
@@ -93,11 +151,11 @@ async def cmd_start(message: types.Message, db: Database, state: FSMContext):
     if not user:
         # Check for referral
         referred_by = None
-        args = message.text.split()[1:] if len(message.text.split()) > 1 else []
-        if len(args) > 0 and args[0].startswith("ref_"):
-            referrer_id = int(args[0].replace("ref_", ""))
-            if referrer_id != telegram_id:
-                referred_by = referrer_id
+        args = message.text.split()[1:]
+        if args and args[0].startswith("ref_"):
+            payload = args[0].removeprefix("ref_")
+            if payload.isdigit() and int(payload) != telegram_id:
+                referred_by = int(payload)
         
         # Create new user
         marzban_username = generate_marzban_username(telegram_id)
@@ -109,31 +167,17 @@ async def cmd_start(message: types.Message, db: Database, state: FSMContext):
         )
         
         if referred_by:
+            # The referrer notification shouldn't delay the new user's welcome
+            task = asyncio.create_task(
+                _notify_referrer(message.bot, db, referred_by, message.from_user.username)
+            )
+            _notify_tasks.add(task)
+            task.add_done_callback(_notify_tasks.discard)
             await db.add_referral(referred_by, telegram_id)
-            referrer = await db.get_user(referred_by)
-            if referrer:
-                try:
-                    await message.bot.send_message(
-                        referred_by,
-                        f"🎉 Ваш реферал @{message.from_user.username or 'user'} зарегистрировался!\n"
-                        f"Когда он купит подписку, вы получите бонусные дни."
-                    )
-                except Exception as e:
-                    logger.error(f"Failed to notify referrer: {e}")
         
-        welcome_text = (
-            f"👋 Привет, @{message.from_user.username or 'user'}!\n\n"
-            f"🤖 Добро пожаловать в VPN бот!\n\n"
-            f"🔐 Быстрый и надежный VPN для ваших нужд\n"
-            f"📱 Работает на всех устройствах\n"
-            f"⚡ Мгновенная активация\n\n"
-            f"Нажмите 🔑 Мой VPN чтобы начать!"
-        )
+        welcome_text = _WELCOME_NEW_TMPL.format(u=message.from_user.username or 'user')
     else:
-        welcome_text = (
-            f"👋 С возвращением, @{message.from_user.username or 'user'}!\n\n"
-            f"Выберите действие в меню:"
-        )
+        welcome_text = _WELCOME_RETURN_TMPL.format(u=message.from_user.username or 'user')
     
     await message.answer(welcome_text, reply_markup=get_main_keyboard())
 
@@ -156,13 +200,11 @@ async def my_vpn(callback: types.CallbackQuery, db: Database):
     subscription = await db.get_active_subscription(telegram_id)
     
     if subscription:
-        # Get user info from Marzban
-        user = await db.get_user(telegram_id)
         text = (
             "🔑 Ваш VPN активен!\n\n"
-            f"📊 Тариф: {subscription['tariff_id']}\n"
-            f"⏳ Истекает: {subscription['expires_at']}\n"
-            f"📈 Трафик: {subscription['traffic_used_gb']:.2f} / {subscription['traffic_limit_gb']:.2f} GB\n\n"
+            f"📊 Тариф: {subscription.tariff_id}\n"
+            f"⏳ Истекает: {subscription.expires_at}\n"
+            f"📈 Трафик: {subscription.traffic_used_gb:.2f} / {subscription.traffic_limit_gb:.2f} GB\n\n"
             f"Используйте кнопки ниже для управления."
         )
     else:
@@ -181,26 +223,9 @@ async def my_vpn(callback: types.CallbackQuery, db: Database):
 @user_router.callback_query(F.data == "tariffs")
 async def show_tariffs(callback: types.CallbackQuery, db: Database):
     """Show available tariffs"""
-    with open("data/tarifs.json", "r", encoding="utf-8") as f:
-        tariffs_data = json.load(f)
-    
-    tariffs = tariffs_data.get("tariffs", [])
-    
-    text = "💰 Доступные тарифы:\n\n"
-    for tariff in tariffs:
-        text += f"{tariff['name']}\n"
-        text += f"💵 Цена: {tariff['price']}₽\n"
-        text += f"⏳ Срок: {tariff['duration_days']} дн.\n"
-        text += f"🔗 Устройств: {tariff['max_ips']}\n"
-        if tariff.get('location'):
-            text += f"🌍 Локация: {tariff['location']}\n"
-        if tariff.get('is_trial'):
-            text += "✅ Пробный период\n"
-        text += "\n"
-    
     await callback.message.edit_text(
-        text,
-        reply_markup=get_tariffs_keyboard(tariffs)
+        _tariffs_text(get_tariffs_version()),
+        reply_markup=get_tariffs_keyboard()
     )
     await callback.answer()
 
@@ -209,12 +234,9 @@ async def show_tariffs(callback: types.CallbackQuery, db: Database):
 @user_router.callback_query(F.data.startswith("tariff_"))
 async def select_tariff(callback: types.CallbackQuery, db: Database):
     """Handle tariff selection"""
-    tariff_id = callback.data.replace("tariff_", "")
+    tariff_id = callback.data.removeprefix("tariff_")
     
-    with open("data/tarifs.json", "r", encoding="utf-8") as f:
-        tariffs_data = json.load(f)
-    
-    tariff = next((t for t in tariffs_data["tariffs"] if t["id"] == tariff_id), None)
+    tariff = get_tariff(tariff_id)
     if not tariff:
         await callback.answer("❌ Тариф не найден", show_alert=True)
         return
@@ -249,15 +271,11 @@ async def select_tariff(callback: types.CallbackQuery, db: Database):
 
 
 @user_router.callback_query(F.data.startswith("trial_"))
-async def activate_trial(callback: types.CallbackQuery, db: Database):
+async def activate_trial(callback: types.CallbackQuery, db: Database, marzban_client: MarzbanClient):
     """Activate trial subscription"""
-    marzban_client = globals._marzban_client
-    tariff_id = callback.data.replace("trial_", "")
-    
-    with open("data/tarifs.json", "r", encoding="utf-8") as f:
-        tariffs_data = json.load(f)
+    tariff_id = callback.data.removeprefix("trial_")
     
-    tariff = next((t for t in tariffs_data["tariffs"] if t["id"] == tariff_id), None)
+    tariff = get_tariff(tariff_id)
     if not tariff:
         await callback.answer("❌ Тариф не найден", show_alert=True)
         return
@@ -270,15 +288,17 @@ async def activate_trial(callback: types.CallbackQuery, db: Database):
     await activate_subscription(callback, db, tariff, marzban_client, is_trial=True)
 
 @user_router.callback_query(F.data.startswith("pay_"))
-async def initiate_payment(callback: types.CallbackQuery, db: Database, config: dict, state: FSMContext):
+async def initiate_payment(
+    callback: types.CallbackQuery,
+    db: Database,
+    config: dict,
+    state: FSMContext,
+    marzban_client: MarzbanClient
+):
     """Initiate payment process"""
-    marzban_client = globals._marzban_client
-    tariff_id = callback.data.replace("pay_", "")
+    tariff_id = callback.data.removeprefix("pay_")
     
-    with open("data/tarifs.json", "r", encoding="utf-8") as f:
-        tariffs_data = json.load(f)
-    
-    tariff = next((t for t in tariffs_data["tariffs"] if t["id"] == tariff_id), None)
+    tariff = get_tariff(tariff_id)
     if not tariff:
         await callback.answer("❌ Тариф не найден", show_alert=True)
         return
@@ -289,15 +309,14 @@ async def initiate_payment(callback: types.CallbackQuery, db: Database, config:
         return
     
     # Generate payment comment
+    payment_comment = generate_payment_comment()
     
     # Generate YooMoney payment link
     yoomoney = YooMoneyClient(
         card_number=config.YOOMONEY_CARD_NUMBER or "4100119471541990",
-        label=config.YOOMONEY_LABEL or "Pojertvovanie",
-        token=config.YOOMONEY_TOKEN
+        label=config.YOOMONEY_LABEL or "Pojertvovanie"
     )
     payment_link = yoomoney.generate_payment_link(tariff["price"], payment_comment)
-    payment_comment = generate_payment_comment()
     
     # Create payment record
     payment_id = await db.add_payment(
@@ -311,25 +330,18 @@ async def initiate_payment(callback: types.CallbackQuery, db: Database, config:
         f"💳 Оплата подписки\n\n"
         f"📦 Тариф: {tariff['name']}\n"
         f"💵 Сумма: {tariff['price']}₽\n\n"
-        f"💳 Карта: `{config.YOOMONEY_CARD_NUMBER or '0000 0000 0000 0000'}`\n"
-        f"🏦 Получатель: SkyNet MVP
-"
-f"📝 Назначение: {config.YOOMONEY_LABEL or "Пожертвование"}
-
-"
-f"🔗 Быстрая оплата (кликните):
-{payment_link}
-
-"\n\n"
+        f"💳 Карта: <code>{html.escape(config.YOOMONEY_CARD_NUMBER or '0000 0000 0000 0000')}</code>\n"
+        f"🏦 Получатель: SkyNet MVP\n"
+        f"📝 Назначение: {html.escape(config.YOOMONEY_LABEL or 'Пожертвование')}\n\n"
+        f"🔗 Быстрая оплата (кликните):\n{html.escape(payment_link)}\n\n"
         f"⚠️ Важно: В комментарии к платежу укажите:\n"
-        f"🔢 `{payment_comment}`\n\n"
+        f"🔢 <code>{payment_comment}</code>\n\n"
         f"После оплаты нажмите ✅ Подтверждаю оплату"
     )
     
     await callback.message.edit_text(
         text,
-        reply_markup=get_payment_confirm_keyboard(payment_id),
-        parse_mode="Markdown"
+        reply_markup=get_payment_confirm_keyboard(payment_id)
     )
     await state.set_state(PaymentStates.waiting_for_confirmation)
     await callback.answer()
@@ -353,10 +365,10 @@ async def activate_subscription(
     # Create user in Marzban
     
     data_limit = tariff.get("traffic_gb", 0) * 1024 * 1024 * 1024  # Convert to bytes
-    expire = globals._marzban_client.calculate_expire_timestamp(tariff["duration_days"])
+    expire = marzban_client.calculate_expire_timestamp(tariff["duration_days"])
     
     try:
-        await globals._marzban_client.create_user(
+        await marzban_client.create_user(
             username=user["marzban_username"],
             data_limit=data_limit,
             expire=expire,
@@ -369,7 +381,7 @@ async def activate_subscription(
         return
     
     # Add subscription to database
-    expires_at = datetime.utcnow() + timedelta(days=tariff["duration_days"])
+    expires_at = datetime.fromtimestamp(expire, tz=timezone.utc)
     await db.add_subscription(
         telegram_id=telegram_id,
         tariff_id=tariff["id"],
@@ -379,25 +391,25 @@ async def activate_subscription(
     )
     
     # Get subscription link
-    sub_link = globals._marzban_client.get_subscription_link(user["marzban_username"])
+    sub_link = marzban_client.get_subscription_link(user["marzban_username"])
     
     text = (
         f"✅ Подписка активирована!\n\n"
         f"📦 Тариф: {tariff['name']}\n"
         f"⏳ Срок: {tariff['duration_days']} дн.\n"
         f"📊 Трафик: {tariff.get('traffic_gb', 0)} GB\n\n"
-        f"🔗 Ссылка для подключения:\n`{sub_link}`\n\n"
+        f"🔗 Ссылка для подключения:\n<code>{html.escape(sub_link)}</code>\n\n"
         f"Нажмите 🔗 Получить ссылку в любое время"
     )
     
-    await callback.message.edit_text(text, parse_mode="Markdown")
+    await callback.message.edit_text(text)
     await callback.answer("✅ Подписка активирована!")
 
 
 @user_router.callback_query(F.data.startswith("confirm_payment_"))
 async def confirm_payment(callback: types.CallbackQuery, db: Database, state: FSMContext):
     """User confirms payment"""
-    payment_id = int(callback.data.replace("confirm_payment_", ""))
+    payment_id = int(callback.data.removeprefix("confirm_payment_"))
     payment = await db.get_payment(payment_id)
     
     if not payment:
@@ -421,48 +433,40 @@ async def confirm_payment(callback: types.CallbackQuery, db: Database, state: FS
 
 
 @user_router.callback_query(F.data == "get_link")
-async def get_subscription_link(callback: types.CallbackQuery, db: Database):
+async def get_subscription_link(callback: types.CallbackQuery, db: Database, marzban_client: MarzbanClient):
     """Get subscription link"""
-    marzban_client = globals._marzban_client
     telegram_id = callback.from_user.id
-    user = await db.get_user(telegram_id)
-    subscription = await db.get_active_subscription(telegram_id)
+    user, subscription, _ = await db.get_user_overview(telegram_id)
     
     if not user or not subscription:
         await callback.answer("❌ Нет активной подписки", show_alert=True)
         return
     
-    sub_link = globals._marzban_client.get_subscription_link(user["marzban_username"])
+    sub_link = marzban_client.get_subscription_link(user["marzban_username"])
     
     text = (
         "🔗 Ваша ссылка для подключения:\n\n"
-        f"`{sub_link}`\n\n"
+        f"<code>{html.escape(sub_link)}</code>\n\n"
         "Скопируйте и вставьте в VPN клиент"
     )
     
-    await callback.message.answer(text, parse_mode="Markdown")
+    await callback.message.answer(text)
     await callback.answer()
 
 
 @user_router.callback_query(F.data == "get_qr")
-async def get_qr_code(callback: types.CallbackQuery, db: Database):
+async def get_qr_code(callback: types.CallbackQuery, db: Database, marzban_client: MarzbanClient):
     """Get QR code for subscription"""
-    marzban_client = globals._marzban_client
     telegram_id = callback.from_user.id
-    user = await db.get_user(telegram_id)
-    subscription = await db.get_active_subscription(telegram_id)
+    user, subscription, _ = await db.get_user_overview(telegram_id)
     
     if not user or not subscription:
         await callback.answer("❌ Нет активной подписки", show_alert=True)
         return
     
-    sub_link = globals._marzban_client.get_subscription_link(user["marzban_username"])
+    sub_link = marzban_client.get_subscription_link(user["marzban_username"])
     
     # Send QR code
-    from aiogram.utils.keyboard import InlineKeyboardBuilder
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🔗 Ссылка", callback_data="get_link")
-    
     await callback.message.answer(
         f"📱 Отсканируйте QR код для быстрого подключения:\n\n{sub_link}"
     )
@@ -474,15 +478,13 @@ async def get_qr_code(callback: types.CallbackQuery, db: Database):
 async def renew_subscription(callback: types.CallbackQuery, db: Database, marzban_client: MarzbanClient):
     """Renew subscription - get fresh link"""
     telegram_id = callback.from_user.id
-    user = await db.get_user(telegram_id)
-    subscription = await db.get_active_subscription(telegram_id)
+    user, subscription, _ = await db.get_user_overview(telegram_id)
     
     if not user or not subscription:
         await callback.answer("❌ Нет активной подписки", show_alert=True)
         return
     
-    marzban_username = user.get("marzban_username")
-    sub_link = f"https://94.176.3.195:8443/sub/{marzban_username}"
+    sub_link = marzban_client.get_subscription_link(user["marzban_username"])
     
     text = "🔄 Ссылка обновлена:\n\n" + sub_link + "\n\nСкопируйте и вставьте в VPN клиент"
     
@@ -492,22 +494,19 @@ async def renew_subscription(callback: types.CallbackQuery, db: Database, marzba
 @user_router.callback_query(F.data == "status")
 async def check_status(callback: types.CallbackQuery, db: Database):
     """Check subscription status"""
-    marzban_client = globals._marzban_client
     telegram_id = callback.from_user.id
     subscription = await db.get_active_subscription(telegram_id)
     
     if subscription:
-        # Try to get actual usage from Marzban
-        user = await db.get_user(telegram_id)
-        traffic_used = subscription.get("traffic_used_gb", 0)
+        traffic_used = subscription.traffic_used_gb or 0
         
         text = (
             "📊 Статус подписки\n\n"
             f"✅ Статус: Активна\n"
-            f"📦 Тариф: {subscription['tariff_id']}\n"
-            f"⏳ Истекает: {subscription['expires_at']}\n"
-            f"📈 Трафик: {traffic_used:.2f} / {subscription['traffic_limit_gb']:.2f} GB\n"
-            f"📅 Дата покупки: {subscription['created_at']}"
+            f"📦 Тариф: {subscription.tariff_id}\n"
+            f"⏳ Истекает: {subscription.expires_at}\n"
+            f"📈 Трафик: {traffic_used:.2f} / {subscription.traffic_limit_gb:.2f} GB\n"
+            f"📅 Дата покупки: {subscription.created_at}"
         )
     else:
         text = (
@@ -527,20 +526,19 @@ async def show_referrals(callback: types.CallbackQuery, db: Database, config: di
     referral_count = await db.get_referral_count(telegram_id)
 
     # Generate referral link
-    ref_link = f"https://t.me/{(await callback.bot.get_me()).username}?start=ref_{telegram_id}"
+    ref_link = _REF_LINK_TMPL.format(u=globals._bot_username, tid=telegram_id)
 
     text = (
         "🎁 Реферальная программа\n\n"
         f"👥 Ваши рефералы: {referral_count}\n\n"
         f"Пригласите друзей и получите бонусные дни!\n"
         f"🎁 +{config.REF_BONUS_DAYS or 7} дней за каждого друга\n\n"
-        f"Ваша ссылка:\n`{ref_link}`"
+        f"Ваша ссылка:\n<code>{ref_link}</code>"
     )
 
     await callback.message.edit_text(
         text,
-        reply_markup=get_referral_keyboard(ref_link),
-        parse_mode="Markdown"
+        reply_markup=get_referral_keyboard(ref_link)
     )
     await callback.answer()
 
@@ -549,7 +547,7 @@ async def show_referrals(callback: types.CallbackQuery, db: Database, config: di
 async def copy_referral(callback: types.CallbackQuery, db: Database):
     """Copy referral link"""
     telegram_id = callback.from_user.id
-    ref_link = f"https://t.me/{(await callback.bot.get_me()).username}?start=ref_{telegram_id}"
+    ref_link = _REF_LINK_TMPL.format(u=globals._bot_username, tid=telegram_id)
     
     await callback.answer(f"📋 {ref_link}", show_alert=True)
 
@@ -557,19 +555,8 @@ async def copy_referral(callback: types.CallbackQuery, db: Database):
 @user_router.callback_query(F.data == "help")
 async def show_help(callback: types.CallbackQuery, config: dict):
     """Show help information"""
-    text = (
-        "ℹ️ Помощь\n\n"
-        "🤖 Этот бот поможет вам купить и управлять VPN подпиской.\n\n"
-        "📋 Команды:\n"
-        "🔑 Мой VPN - управление подпиской\n"
-        "💰 Тарифы - выбрать тариф\n"
-        "📊 Статус - проверить статус\n"
-        "🎁 Рефералы - пригласить друзей\n\n"
-        "❓ Нужна помощь? Свяжитесь с поддержкой."
-    )
-    
     await callback.message.edit_text(
-        text,
+        _HELP_TEXT,
         reply_markup=get_help_keyboard()
     )
     await callback.answer()
@@ -579,7 +566,7 @@ async def show_help(callback: types.CallbackQuery, config: dict):
 async def contact_support(callback: types.CallbackQuery, config: dict):
     """Contact support"""
     support_url = config.SUPPORT_URL or "https://t.me/support"
-    text = f"📞 Поддержка\n\nСвяжитесь с нами: {support_url}"
+    text = _SUPPORT_TMPL.format(url=support_url)
     await callback.message.answer(text)
     await callback.answer()
 
@@ -588,7 +575,7 @@ async def contact_support(callback: types.CallbackQuery, config: dict):
 async def show_channel(callback: types.CallbackQuery, config: dict):
     """Show channel link"""
     channel_url = config.TG_CHANNEL or "https://t.me/channel"
-    text = f"📢 Наш канал: {channel_url}"
+    text = _CHANNEL_TMPL.format(url=channel_url)
     await callback.message.answer(text)
     await callback.answer()
 
@@ -597,30 +584,26 @@ async def show_channel(callback: types.CallbackQuery, config: dict):
 async def show_profile(callback: types.CallbackQuery, db: Database):
     """Show user profile"""
     telegram_id = callback.from_user.id
-    user = await db.get_user(telegram_id)
+    user, subscription, referral_count = await db.get_user_overview(telegram_id)
     
     if not user:
         await callback.answer("❌ Пользователь не найден", show_alert=True)
         return
     
-    subscription = await db.get_active_subscription(telegram_id)
-    referral_count = await db.get_referral_count(telegram_id)
-    
     text = (
         f"👤 Профиль\n\n"
-        f"ID: `{telegram_id}`\n"
-        f"Username: @{user['username']}\n"
+        f"ID: <code>{telegram_id}</code>\n"
+        f"Username: @{html.escape(user['username'] or '')}\n"
         f"📅 Регистрация: {user['created_at']}\n\n"
         f"🎁 Рефералов: {referral_count}\n"
         f"🔑 Подписка: {'✅ Активна' if subscription else '❌ Не активна'}\n"
     )
     
     if subscription:
-        text += f"⏳ Истекает: {subscription['expires_at']}"
+        text += f"⏳ Истекает: {subscription.expires_at}"
     
     await callback.message.edit_text(
         text,
-        reply_markup=get_back_keyboard(),
-        parse_mode="Markdown"
+        reply_markup=get_back_keyboard()
     )
     await callback.answer()
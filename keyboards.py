@@ -3,10 +3,15 @@ Keyboard Layouts Module
 Contains all inline and reply keyboards for the bot
 """
 
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+from functools import lru_cache
 
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from tariffs import get_tariffs, get_tariffs_version
+
+
+@lru_cache(maxsize=None)
 def get_main_keyboard() -> InlineKeyboardMarkup:
     """Main menu keyboard for users"""
     builder = InlineKeyboardBuilder()
@@ -20,10 +25,16 @@ def get_main_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
-def get_tariffs_keyboard(tariffs: list) -> InlineKeyboardMarkup:
+def get_tariffs_keyboard() -> InlineKeyboardMarkup:
     """Keyboard with tariff selection"""
+    return _tariffs_keyboard(get_tariffs_version())
+
+
+@lru_cache(maxsize=4)
+def _tariffs_keyboard(version: int) -> InlineKeyboardMarkup:
+    """Build the tariff selection keyboard once per tariffs file version"""
     builder = InlineKeyboardBuilder()
-    for tariff in tariffs:
+    for tariff in get_tariffs():
         builder.button(
             text=f"{tariff['name']} - {tariff['price']}₽",
             callback_data=f"tariff_{tariff['id']}"
@@ -33,33 +44,33 @@ def get_tariffs_keyboard(tariffs: list) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=128)
 def get_tariff_confirm_keyboard(tariff_id: str) -> InlineKeyboardMarkup:
     """Keyboard for confirming tariff purchase"""
-    builder = InlineKeyboardBuilder()
-    builder.button(text="💳 Оплатить", callback_data=f"pay_{tariff_id}")
-    builder.button(text="↩️ Назад", callback_data="tariffs")
-    builder.adjust(2)
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="💳 Оплатить", callback_data=f"pay_{tariff_id}"),
+        InlineKeyboardButton(text="↩️ Назад", callback_data="tariffs"),
+    ]])
 
 
+@lru_cache(maxsize=128)
 def get_trial_confirm_keyboard(tariff_id: str) -> InlineKeyboardMarkup:
     """Keyboard for confirming trial subscription"""
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🎁 Получить", callback_data=f"trial_{tariff_id}")
-    builder.button(text="↩️ Назад", callback_data="tariffs")
-    builder.adjust(2)
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="🎁 Получить", callback_data=f"trial_{tariff_id}"),
+        InlineKeyboardButton(text="↩️ Назад", callback_data="tariffs"),
+    ]])
 
 
 def get_payment_confirm_keyboard(payment_id: int) -> InlineKeyboardMarkup:
     """Keyboard for confirming payment"""
-    builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Подтверждаю оплату", callback_data=f"confirm_payment_{payment_id}")
-    builder.button(text="❌ Отмена", callback_data="cancel_payment")
-    builder.adjust(2)
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Подтверждаю оплату", callback_data=f"confirm_payment_{payment_id}"),
+        InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_payment"),
+    ]])
 
 
+@lru_cache(maxsize=None)
 def get_my_vpn_keyboard(subscription_active: bool) -> InlineKeyboardMarkup:
     """Keyboard for VPN management"""
     builder = InlineKeyboardBuilder()
@@ -76,13 +87,13 @@ def get_my_vpn_keyboard(subscription_active: bool) -> InlineKeyboardMarkup:
 
 def get_referral_keyboard(referral_link: str) -> InlineKeyboardMarkup:
     """Keyboard for referrals"""
-    builder = InlineKeyboardBuilder()
-    builder.button(text="📋 Копировать ссылку", callback_data="copy_referral")
-    builder.button(text="↩️ Назад", callback_data="back_to_main")
-    builder.adjust(1)
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📋 Копировать ссылку", callback_data="copy_referral")],
+        [InlineKeyboardButton(text="↩️ Назад", callback_data="back_to_main")],
+    ])
 
 
+@lru_cache(maxsize=None)
 def get_help_keyboard() -> InlineKeyboardMarkup:
     """Keyboard for help section"""
     builder = InlineKeyboardBuilder()
@@ -93,6 +104,7 @@ def get_help_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=None)
 def get_admin_keyboard() -> InlineKeyboardMarkup:
     """Admin menu keyboard"""
     builder = InlineKeyboardBuilder()
@@ -108,17 +120,28 @@ def get_admin_keyboard() -> InlineKeyboardMarkup:
 
 def get_pending_payments_keyboard(payments: list) -> InlineKeyboardMarkup:
     """Keyboard with pending payments for admin"""
+    # Show max 10 payments
+    return _pending_payments_keyboard(tuple(
+        (payment['id'], payment['amount'], payment['tg_username'])
+        for payment in payments[:10]
+    ))
+
+
+@lru_cache(maxsize=512)
+def _pending_payments_keyboard(payments: tuple) -> InlineKeyboardMarkup:
+    """Build the pending payments keyboard from hashable (id, amount, username) entries"""
     builder = InlineKeyboardBuilder()
-    for payment in payments[:10]:  # Show max 10 payments
+    for payment_id, amount, tg_username in payments:
         builder.button(
-            text=f"💰 {payment['amount']}₽ - @{payment.get('tg_username', 'user')}",
-            callback_data=f"payment_view_{payment['id']}"
+            text=f"💰 {amount}₽ - @{tg_username}",
+            callback_data=f"payment_view_{payment_id}"
         )
     builder.button(text="↩️ Назад", callback_data="back_to_admin")
     builder.adjust(1)
     return builder.as_markup()
 
 
+@lru_cache(maxsize=512)
 def get_payment_review_keyboard(payment_id: int) -> InlineKeyboardMarkup:
     """Keyboard for reviewing a payment"""
     builder = InlineKeyboardBuilder()
@@ -129,22 +152,24 @@ def get_payment_review_keyboard(payment_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=None)
 def get_back_keyboard() -> InlineKeyboardMarkup:
     """Simple back button"""
-    builder = InlineKeyboardBuilder()
-    builder.button(text="↩️ Назад", callback_data="back_to_main")
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="↩️ Назад", callback_data="back_to_main"),
+    ]])
 
 
+@lru_cache(maxsize=128)
 def get_yes_no_keyboard(yes_callback: str, no_callback: str) -> InlineKeyboardMarkup:
     """Yes/No confirmation keyboard"""
-    builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Да", callback_data=yes_callback)
-    builder.button(text="❌ Нет", callback_data=no_callback)
-    builder.adjust(2)
-    return builder.as_markup()
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="✅ Да", callback_data=yes_callback),
+        InlineKeyboardButton(text="❌ Нет", callback_data=no_callback),
+    ]])
 
 
+@lru_cache(maxsize=None)
 def get_user_search_keyboard() -> InlineKeyboardMarkup:
     """Keyboard for user search"""
     builder = InlineKeyboardBuilder()
@@ -155,6 +180,7 @@ def get_user_search_keyboard() -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=512)
 def get_user_management_keyboard(telegram_id: int) -> InlineKeyboardMarkup:
     """Keyboard for managing a specific user"""
     builder = InlineKeyboardBuilder()
@@ -166,6 +192,7 @@ def get_user_management_keyboard(telegram_id: int) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+@lru_cache(maxsize=None)
 def get_broadcast_keyboard() -> InlineKeyboardMarkup:
     """Keyboard for broadcast message"""
     builder = InlineKeyboardBuilder()
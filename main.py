@@ -4,18 +4,41 @@ Telegram bot for managing VPN subscriptions via Marzban panel
 """
 
 import asyncio
+import atexit
+import html
 import logging
+import queue
 import sys
+from dataclasses import dataclass
+from functools import cache
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from types import MappingProxyType
+from typing import Any, FrozenSet, Mapping, Tuple
 from dotenv import load_dotenv
 import os
 
-from aiogram import Bot, Dispatcher, F, types
+from aiogram import Bot, Dispatcher, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import ErrorEvent
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+# uvloop is optional; fall back to the default asyncio loop where it isn't installed
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Redis FSM storage needs the optional redis package
+try:
+    from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+except ImportError:
+    RedisStorage = None
 
 # Load environment variables
 load_dotenv()
@@ -27,71 +50,135 @@ import globals
 from handlers_user import user_router
 from handlers_admin import admin_router, is_admin
 from background_tasks import start_background_tasks
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("logs/bot.log", encoding="utf-8")
-    ]
-)
+from tariffs import reload_tariffs
+from throttling import TelegramLimiter
 
 # Create logs directory
 Path("logs").mkdir(parents=True, exist_ok=True)
 
+# Configure logging; records are queued and written by a background thread
+# so console and file I/O never blocks the event loop
+_log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+_log_handlers = [
+    logging.StreamHandler(sys.stdout),
+    logging.FileHandler("logs/bot.log", encoding="utf-8")
+]
+for _handler in _log_handlers:
+    _handler.setFormatter(_log_formatter)
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_queue_handler = QueueHandler(_log_queue)
+# The listener's handlers apply the real format; only merge tracebacks here
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+
 logger = logging.getLogger(__name__)
 
+# Seconds Telegram holds a getUpdates call open when there is nothing to deliver
+POLLING_TIMEOUT = 30
+
+# Seconds an error report to a single admin may take before it is abandoned
+ADMIN_NOTIFY_TIMEOUT = 3
+
 
+@dataclass(frozen=True, slots=True)
 class Config:
     """Bot configuration"""
     
-    def __init__(self):
-        # Bot configuration
-        self.BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-        
-        # Admin configuration
-        self.ADMIN_USER_IDS = os.getenv("ADMIN_USER_IDS", "").split(",")
-        
-        # Marzban configuration
-        self.MARZBAN_PANEL_URL = os.getenv("MARZBAN_PANEL_URL", "")
-        self.MARZBAN_USERNAME = os.getenv("MARZBAN_USERNAME", "")
-        self.MARZBAN_PASSWORD = os.getenv("MARZBAN_PASSWORD", "")
-        self.MARZBAN_SUBSCRIPTION_URL_PREFIX = os.getenv(
-            "MARZBAN_SUBSCRIPTION_URL_PREFIX", 
-            self.MARZBAN_PANEL_URL
-        )
-        
-        # Payment configuration
-        self.PAYMENT_CARD_NUMBER = os.getenv("PAYMENT_CARD_NUMBER", "")
-        self.PAYMENT_CARD_HOLDER = os.getenv("PAYMENT_CARD_HOLDER", "")
-        
-        # YooMoney configuration
-        self.YOOMONEY_CARD_NUMBER = os.getenv("YOOMONEY_CARD_NUMBER", "4100119471541990")
-        self.YOOMONEY_LABEL = os.getenv("YOOMONEY_LABEL", "Пожертвование")
-        self.YOOMONEY_TOKEN = os.getenv("YOOMONEY_TOKEN", "")
-        
-        # Optional configuration
-        self.SITE_URL = os.getenv("SITE_URL", "")
-        self.TG_CHANNEL = os.getenv("TG_CHANNEL", "")
-        self.SUPPORT_URL = os.getenv("SUPPORT_URL", "")
-        self.REF_BONUS_DAYS = int(os.getenv("REF_BONUS_DAYS", "7"))
-        self.VERIFY_SSL = os.getenv("VERIFY_SSL", "true").lower() == "true"
-        
-        # Notification settings
+    # Bot configuration
+    BOT_TOKEN: str
+    
+    # Admin configuration; parsed once for O(1) admin checks in handlers and filters
+    ADMIN_USER_IDS: FrozenSet[int]
+    
+    # Marzban configuration
+    MARZBAN_PANEL_URL: str
+    MARZBAN_USERNAME: str
+    MARZBAN_PASSWORD: str
+    MARZBAN_SUBSCRIPTION_URL_PREFIX: str
+    MARZBAN_MAX_CONNECTIONS: int
+    
+    # Payment configuration
+    PAYMENT_CARD_NUMBER: str
+    PAYMENT_CARD_HOLDER: str
+    
+    # YooMoney configuration
+    YOOMONEY_CARD_NUMBER: str
+    YOOMONEY_LABEL: str
+    YOOMONEY_TOKEN: str
+    
+    # Optional configuration
+    SITE_URL: str
+    TG_CHANNEL: str
+    SUPPORT_URL: str
+    REF_BONUS_DAYS: int
+    VERIFY_SSL: bool
+    
+    # Webhook configuration; polling is used when WEBHOOK_URL is empty
+    WEBHOOK_URL: str
+    WEBHOOK_PATH: str
+    WEBHOOK_SECRET: str
+    WEBHOOK_HOST: str
+    WEBHOOK_PORT: int
+    
+    # FSM storage; in-memory when REDIS_URL is empty
+    REDIS_URL: str
+    
+    # Database configuration
+    DB_READ_POOL_SIZE: int
+    
+    # Notification settings; sorted, without duplicates
+    NOTIFY_BEFORE_EXPIRE_HOURS: Tuple[int, ...]
+    
+    @classmethod
+    @cache
+    def from_env(cls) -> "Config":
+        """Build the configuration from environment variables, once per process"""
+        panel_url = os.getenv("MARZBAN_PANEL_URL", "")
         notify_hours = os.getenv("NOTIFY_BEFORE_EXPIRE_HOURS", "24,48,72")
-        self.NOTIFY_BEFORE_EXPIRE_HOURS = [int(h) for h in notify_hours.split(",")]
+        return cls(
+            BOT_TOKEN=os.getenv("BOT_TOKEN", ""),
+            ADMIN_USER_IDS=frozenset(
+                int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x.strip()
+            ),
+            MARZBAN_PANEL_URL=panel_url,
+            MARZBAN_USERNAME=os.getenv("MARZBAN_USERNAME", ""),
+            MARZBAN_PASSWORD=os.getenv("MARZBAN_PASSWORD", ""),
+            MARZBAN_SUBSCRIPTION_URL_PREFIX=os.getenv("MARZBAN_SUBSCRIPTION_URL_PREFIX", panel_url),
+            MARZBAN_MAX_CONNECTIONS=int(os.getenv("MARZBAN_MAX_CONNECTIONS", "30")),
+            PAYMENT_CARD_NUMBER=os.getenv("PAYMENT_CARD_NUMBER", ""),
+            PAYMENT_CARD_HOLDER=os.getenv("PAYMENT_CARD_HOLDER", ""),
+            YOOMONEY_CARD_NUMBER=os.getenv("YOOMONEY_CARD_NUMBER", "4100119471541990"),
+            YOOMONEY_LABEL=os.getenv("YOOMONEY_LABEL", "Пожертвование"),
+            YOOMONEY_TOKEN=os.getenv("YOOMONEY_TOKEN", ""),
+            SITE_URL=os.getenv("SITE_URL", ""),
+            TG_CHANNEL=os.getenv("TG_CHANNEL", ""),
+            SUPPORT_URL=os.getenv("SUPPORT_URL", ""),
+            REF_BONUS_DAYS=int(os.getenv("REF_BONUS_DAYS", "7")),
+            VERIFY_SSL=os.getenv("VERIFY_SSL", "true").lower() == "true",
+            WEBHOOK_URL=os.getenv("WEBHOOK_URL", ""),
+            WEBHOOK_PATH=os.getenv("WEBHOOK_PATH", "/webhook"),
+            WEBHOOK_SECRET=os.getenv("WEBHOOK_SECRET", ""),
+            WEBHOOK_HOST=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            WEBHOOK_PORT=int(os.getenv("WEBHOOK_PORT", "8080")),
+            REDIS_URL=os.getenv("REDIS_URL", ""),
+            DB_READ_POOL_SIZE=int(os.getenv("DB_READ_POOL_SIZE", "5")),
+            NOTIFY_BEFORE_EXPIRE_HOURS=tuple(sorted({int(h) for h in notify_hours.split(",") if h.strip()})),
+        )
     
-    def to_dict(self) -> dict:
-        """Convert config to dictionary"""
-        return {
+    @cache
+    def to_dict(self) -> Mapping[str, Any]:
+        """Convert config to a read-only dictionary"""
+        return MappingProxyType({
             "BOT_TOKEN": self.BOT_TOKEN,
             "ADMIN_USER_IDS": self.ADMIN_USER_IDS,
             "MARZBAN_PANEL_URL": self.MARZBAN_PANEL_URL,
             "MARZBAN_USERNAME": self.MARZBAN_USERNAME,
             "MARZBAN_PASSWORD": self.MARZBAN_PASSWORD,
             "MARZBAN_SUBSCRIPTION_URL_PREFIX": self.MARZBAN_SUBSCRIPTION_URL_PREFIX,
+            "MARZBAN_MAX_CONNECTIONS": self.MARZBAN_MAX_CONNECTIONS,
             "PAYMENT_CARD_NUMBER": self.PAYMENT_CARD_NUMBER,
             "PAYMENT_CARD_HOLDER": self.PAYMENT_CARD_HOLDER,
             "SITE_URL": self.SITE_URL,
@@ -99,8 +186,14 @@ class Config:
             "SUPPORT_URL": self.SUPPORT_URL,
             "REF_BONUS_DAYS": self.REF_BONUS_DAYS,
             "VERIFY_SSL": self.VERIFY_SSL,
+            "WEBHOOK_URL": self.WEBHOOK_URL,
+            "WEBHOOK_PATH": self.WEBHOOK_PATH,
+            "WEBHOOK_HOST": self.WEBHOOK_HOST,
+            "WEBHOOK_PORT": self.WEBHOOK_PORT,
+            "REDIS_URL": self.REDIS_URL,
+            "DB_READ_POOL_SIZE": self.DB_READ_POOL_SIZE,
             "NOTIFY_BEFORE_EXPIRE_HOURS": self.NOTIFY_BEFORE_EXPIRE_HOURS,
-        }
+        })
     
     def validate(self) -> bool:
         """Validate required configuration"""
@@ -111,23 +204,29 @@ class Config:
             logger.error(f"Missing required configuration: {missing}")
             return False
         
-        if not self.ADMIN_USER_IDS or self.ADMIN_USER_IDS[0] == "":
+        if not self.ADMIN_USER_IDS:
             logger.error("No admin user IDs configured")
             return False
         
         return True
 
 
-async def on_startup(bot: Bot, db: Database, marzban_client: MarzbanClient, config: Config):
+async def on_startup(
+    bot: Bot,
+    db: Database,
+    marzban_client: MarzbanClient,
+    config: Config,
+    limiter: TelegramLimiter
+):
     """Bot startup handler"""
     logger.info("Bot starting up...")
     
     # Store marzban_client in bot for handlers
     globals._marzban_client = marzban_client
     
-    # Test Marzban connection
+    # Test Marzban connection and warm up the connection pool
     try:
-        await marzban_client.get_system_stats()
+        await marzban_client.warmup()
         logger.info("Connected to Marzban panel successfully")
     except AuthenticationError as e:
         logger.error(f"Marzban authentication failed: {e}")
@@ -140,8 +239,14 @@ async def on_startup(bot: Bot, db: Database, marzban_client: MarzbanClient, conf
     await db.connect()
     logger.info("Database initialized")
     
+    # Load tariffs before the first handler needs them
+    await reload_tariffs()
+    
     # Start background tasks
-    await start_background_tasks(db, marzban_client, bot, config)
+    await start_background_tasks(db, marzban_client, bot, config, limiter)
+    
+    # Bot username is constant; resolve it once for referral links
+    globals._bot_username = (await bot.get_me()).username
     
     # Set bot commands
     await bot.set_my_commands([
@@ -163,22 +268,31 @@ async def on_shutdown(bot: Bot, db: Database, marzban_client: MarzbanClient):
     logger.info("Bot shutdown completed")
 
 
-async def error_handler(error: ErrorEvent, bot: Bot):
+async def error_handler(error: ErrorEvent, bot: Bot, config: Config):
     """Global error handler"""
     logger.error(f"Global error: {error}", exc_info=error.exception)
     
-    # Notify admins
-    config = Config()
-    for admin_id in config.ADMIN_USER_IDS:
-        try:
-            await bot.send_message(
-                admin_id,
-                f"⚠️ Ошибка в боте:\n\n"
-                f"```\n{str(error.exception)}\n```",
-                parse_mode="Markdown"
-            )
-        except Exception:
-            pass
+    # Notify admins; failed or slow sends are ignored
+    text = f"⚠️ Ошибка в боте:\n\n<pre>{html.escape(str(error.exception))}</pre>"
+    await asyncio.gather(
+        *(
+            asyncio.wait_for(bot.send_message(admin_id, text), timeout=ADMIN_NOTIFY_TIMEOUT)
+            for admin_id in config.ADMIN_USER_IDS
+        ),
+        return_exceptions=True
+    )
+
+
+def create_storage(config: Config) -> BaseStorage:
+    """Create FSM storage; Redis lets several bot processes share conversation state"""
+    if not config.REDIS_URL:
+        return MemoryStorage()
+    if RedisStorage is None:
+        raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+    return RedisStorage.from_url(
+        config.REDIS_URL,
+        key_builder=DefaultKeyBuilder(with_bot_id=True)
+    )
 
 
 def create_dispatcher(config: Config, db: Database, marzban_client: MarzbanClient) -> Dispatcher:
@@ -186,26 +300,21 @@ def create_dispatcher(config: Config, db: Database, marzban_client: MarzbanClien
     # Set global marzban_client for handlers
     globals._marzban_client = marzban_client
     
-    dp = Dispatcher(storage=MemoryStorage())
-    
-    # Add middleware for config and database (BEFORE including routers)
-    @dp.callback_query.middleware()
-    @dp.message.middleware()
-    async def config_middleware(handler, event, data):
-        data["config"] = config
-        data["db"] = db
-        data["marzban_client"] = marzban_client
-        return await handler(event, data)
+    # Shared objects go into workflow data, which aiogram passes to handlers
+    # without a per-update middleware call
+    dp = Dispatcher(
+        storage=create_storage(config),
+        config=config,
+        db=db,
+        marzban_client=marzban_client,
+        # One limiter for broadcasts and background notifications alike
+        limiter=TelegramLimiter()
+    )
     
     # Include routers
     dp.include_router(user_router)
     dp.include_router(admin_router)
     
-    # Admin filter
-    @dp.message(F.from_user.id.map(lambda x: str(x) in config.ADMIN_USER_IDS))
-    async def admin_only(message: types.Message):
-        pass
-    
     # Error handler
     dp.errors.register(error_handler)
     
@@ -216,10 +325,39 @@ def create_dispatcher(config: Config, db: Database, marzban_client: MarzbanClien
     return dp
 
 
+async def run_webhook(dp: Dispatcher, bot: Bot, config: Config):
+    """Serve updates pushed by Telegram instead of polling for them"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=config.WEBHOOK_SECRET or None
+    ).register(app, path=config.WEBHOOK_PATH)
+    # Runs the dispatcher's startup/shutdown hooks with the app
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    await site.start()
+    
+    await bot.set_webhook(
+        url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+        allowed_updates=dp.resolve_used_update_types(),
+        secret_token=config.WEBHOOK_SECRET or None
+    )
+    logger.info(f"Webhook server listening on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}")
+    
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main():
     """Main function"""
     # Load configuration
-    config = Config()
+    config = Config.from_env()
     
     if not config.validate():
         logger.error("Configuration validation failed")
@@ -234,27 +372,32 @@ async def main():
     )
     
     # Create database and Marzban client
-    db = Database()
+    db = Database(read_pool_size=config.DB_READ_POOL_SIZE)
     marzban_client = MarzbanClient(
         panel_url=config.MARZBAN_PANEL_URL,
         username=config.MARZBAN_USERNAME,
         password=config.MARZBAN_PASSWORD,
         subscription_prefix=config.MARZBAN_SUBSCRIPTION_URL_PREFIX,
-        verify_ssl=config.VERIFY_SSL
+        verify_ssl=config.VERIFY_SSL,
+        max_connections=config.MARZBAN_MAX_CONNECTIONS
     )
     
     # Create dispatcher
     dp = create_dispatcher(config, db, marzban_client)
     
-    # Store additional data in dispatcher
-    dp["config"] = config
-    dp["db"] = db
-    dp["marzban_client"] = marzban_client
-    
     try:
-        # Start polling
-        logger.info("Starting bot polling...")
-        await dp.start_polling(bot)
+        if config.WEBHOOK_URL:
+            logger.info("Starting bot webhook...")
+            await run_webhook(dp, bot, config)
+        else:
+            # Start polling; a webhook left over from a previous run would block getUpdates
+            logger.info("Starting bot polling...")
+            await bot.delete_webhook()
+            await dp.start_polling(
+                bot,
+                polling_timeout=POLLING_TIMEOUT,
+                allowed_updates=dp.resolve_used_update_types()
+            )
     except KeyboardInterrupt:
         logger.info("Keyboard interrupt received")
     finally:
@@ -263,7 +406,8 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         pass
     except Exception as e:
@@ -4,47 +4,130 @@ Handles all interactions with the Marzban panel API
 """
 
 import aiohttp
+import asyncio
 import logging
-from typing import Optional, Dict, Any
-from datetime import datetime, timedelta
+import time
+from typing import Optional, Dict, Any, List
+
+import orjson
+
+from throttling import retry
 
 logger = logging.getLogger(__name__)
 
 
+class AuthenticationError(Exception):
+    """Raised when authentication fails"""
+    pass
+
+
+class APIError(Exception):
+    """Raised when API request fails"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+# Network failures plus Marzban 429/5xx responses are retried; 404s are not
+_RETRY_ON = (aiohttp.ClientError, asyncio.TimeoutError, APIError)
+
+_TRAFFIC_UNITS = ("B", "KB", "MB", "GB", "TB", "PB")
+
+
 class MarzbanClient:
+    __slots__ = (
+        "panel_url",
+        "username",
+        "password",
+        "subscription_prefix",
+        "verify_ssl",
+        "max_connections",
+        "_sub_base",
+        "_access_token",
+        "_auth_headers",
+        "_token_deadline",
+        "_auth_lock",
+        "_session",
+    )
+
+    # Marzban tokens live 24h; refresh a little before that
+    TOKEN_LIFETIME = 1430 * 60
+    TOKEN_REFRESH_MARGIN = 5 * 60
+
+    # Keep-alive pool shared by all API calls
+    CONNECTION_LIMIT = 100
+    CONNECTION_LIMIT_PER_HOST = 30
+    DNS_CACHE_TTL = 300
+    KEEPALIVE_TIMEOUT = 75
+    REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=5)
+
     def __init__(
         self,
         panel_url: str,
         username: str,
         password: str,
         subscription_prefix: str = "",
-        verify_ssl: bool = True
+        verify_ssl: bool = True,
+        max_connections: int = CONNECTION_LIMIT_PER_HOST
     ):
         self.panel_url = panel_url.rstrip('/')
         self.username = username
         self.password = password
         self.subscription_prefix = subscription_prefix
         self.verify_ssl = verify_ssl
+        # Use panel_url directly since Marzban caches old subscription prefix
+        self._sub_base = f"{self.panel_url}/sub/"
+        # Open sockets to the panel; concurrent calls beyond this wait for a free one
+        self.max_connections = max_connections
         self._access_token: Optional[str] = None
-        self._token_expires_at: Optional[datetime] = None
+        # Prebuilt Authorization header and its time.monotonic() deadline
+        self._auth_headers: Optional[Dict[str, str]] = None
+        self._token_deadline = 0.0
+        # Only one coroutine refreshes the token; the rest wait for its result
+        self._auth_lock = asyncio.Lock()
         self._session: Optional[aiohttp.ClientSession] = None
 
     async def _get_session(self) -> aiohttp.ClientSession:
         if self._session is None or self._session.closed:
-            connector = aiohttp.TCPConnector(ssl=self.verify_ssl)
-            self._session = aiohttp.ClientSession(connector=connector)
+            connector = aiohttp.TCPConnector(
+                ssl=self.verify_ssl,
+                limit=max(self.CONNECTION_LIMIT, self.max_connections),
+                limit_per_host=self.max_connections,
+                ttl_dns_cache=self.DNS_CACHE_TTL,
+                keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+                enable_cleanup_closed=True
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.REQUEST_TIMEOUT)
         return self._session
 
     async def close(self):
         if self._session and not self._session.closed:
             await self._session.close()
+        # _request relies on _session being None whenever it is unusable
+        self._session = None
+
+    def _token_valid(self, stale_token: Optional[str] = None) -> bool:
+        """Check whether the cached token can still be used"""
+        return (
+            self._auth_headers is not None
+            and time.monotonic() < self._token_deadline
+            and self._access_token != stale_token
+        )
+
+    async def _authenticate(self, stale_token: Optional[str] = None) -> str:
+        """Get or refresh access token; stale_token forces a refresh if it is still current"""
+        if self._token_valid(stale_token):
+            return self._access_token
 
-    async def _authenticate(self) -> str:
-        """Get or refresh access token"""
-        if self._access_token and self._token_expires_at:
-            if datetime.utcnow() < self._token_expires_at - timedelta(minutes=5):
+        async with self._auth_lock:
+            # Another coroutine may have refreshed while we waited
+            if self._token_valid(stale_token):
                 return self._access_token
+            return await self._fetch_token()
 
+    async def _fetch_token(self) -> str:
+        """Request a new access token from the panel"""
         session = await self._get_session()
         url = f"{self.panel_url}/api/admin/token"
         
@@ -58,10 +141,10 @@ class MarzbanClient:
                 error_text = await response.text()
                 raise AuthenticationError(f"Failed to authenticate: {error_text}")
             
-            result = await response.json()
+            result = orjson.loads(await response.read())
             self._access_token = result["access_token"]
-            # Token expires in 24 hours by default
-            self._token_expires_at = datetime.utcnow() + timedelta(minutes=1430)
+            self._auth_headers = {"Authorization": f"Bearer {self._access_token}"}
+            self._token_deadline = time.monotonic() + self.TOKEN_LIFETIME - self.TOKEN_REFRESH_MARGIN
             return self._access_token
 
     async def _request(
@@ -69,33 +152,34 @@ class MarzbanClient:
         method: str,
         endpoint: str,
         json_data: Optional[Dict[str, Any]] = None,
-        params: Optional[Dict[str, Any]] = None
+        params: Optional[Any] = None
     ) -> Dict[str, Any]:
         """Make authenticated request to Marzban API"""
-        session = await self._get_session()
+        session = self._session
+        if session is None:
+            session = await self._get_session()
         url = f"{self.panel_url}{endpoint}"
         
-        headers = {
-            "Authorization": f"Bearer {await self._authenticate()}"
-        }
+        if not self._token_valid():
+            await self._authenticate()
+        token = self._access_token
 
         async with session.request(
             method,
             url,
             json=json_data,
             params=params,
-            headers=headers
+            headers=self._auth_headers
         ) as response:
             if response.status == 401:
-                # Token expired, re-authenticate
-                self._access_token = None
-                headers["Authorization"] = f"Bearer {await self._authenticate()}"
+                # Token expired, re-authenticate unless a concurrent call already did
+                await self._authenticate(stale_token=token)
                 async with session.request(
                     method,
                     url,
                     json=json_data,
                     params=params,
-                    headers=headers
+                    headers=self._auth_headers
                 ) as retry_response:
                     return await self._parse_response(retry_response)
             return await self._parse_response(response)
@@ -103,8 +187,10 @@ class MarzbanClient:
     async def _parse_response(self, response: aiohttp.ClientResponse) -> Dict[str, Any]:
         if response.status >= 400:
             error_text = await response.text()
-            raise APIError(f"API Error {response.status}: {error_text}")
-        return await response.json()
+            raise APIError(f"API Error {response.status}: {error_text}", status=response.status)
+        body = await response.read()
+        # Same as aiohttp's response.json() for empty bodies
+        return orjson.loads(body) if body.strip() else None
 
     # User Management Methods
 
@@ -135,10 +221,46 @@ class MarzbanClient:
 
         return await self._request("POST", "/api/user", json_data=user_data)
 
+    @retry(retry_on=_RETRY_ON)
     async def get_user(self, username: str) -> Dict[str, Any]:
         """Get user information"""
         return await self._request("GET", f"/api/user/{username}")
 
+    async def get_users_bulk(self, usernames: List[str], chunk_size: int = 100) -> Dict[str, Dict[str, Any]]:
+        """Get several users with one /api/users call per chunk, keyed by username"""
+        chunks = [usernames[i:i + chunk_size] for i in range(0, len(usernames), chunk_size)]
+        results = await asyncio.gather(
+            *(self._get_users_chunk(chunk) for chunk in chunks), return_exceptions=True
+        )
+
+        # A failed chunk only loses its own users; callers treat them as unknown
+        users_by_name = {}
+        failed = [result for result in results if isinstance(result, BaseException)]
+        for result in results:
+            if not isinstance(result, BaseException):
+                users_by_name.update((user["username"], user) for user in result)
+        if failed:
+            if len(failed) == len(chunks):
+                raise failed[0]
+            logger.error(f"Bulk user lookup failed for {len(failed)} of {len(chunks)} chunks: {failed[0]}")
+        return users_by_name
+
+    @retry(retry_on=_RETRY_ON)
+    async def _get_users_chunk(self, chunk: List[str]) -> List[Dict[str, Any]]:
+        """Fetch one chunk of users, following offsets if the panel caps the page size"""
+        params = [("username", username) for username in chunk] + [("limit", len(chunk))]
+        users: List[Dict[str, Any]] = []
+        while True:
+            response = await self._request("GET", "/api/users", params=params + [("offset", len(users))])
+            page = response.get("users", [])
+            users.extend(page)
+            total = response.get("total", len(users))
+            if len(users) >= total:
+                return users
+            if not page:
+                logger.warning(f"Bulk user lookup returned {len(users)} of {total} users for a chunk")
+                return users
+
     async def modify_user(
         self,
         username: str,
@@ -147,6 +269,7 @@ class MarzbanClient:
         """Modify an existing user"""
         return await self._request("PUT", f"/api/user/{username}", json_data=kwargs)
 
+    @retry(retry_on=_RETRY_ON)
     async def delete_user(self, username: str) -> Dict[str, Any]:
         """Delete a user"""
         return await self._request("DELETE", f"/api/user/{username}")
@@ -163,9 +286,7 @@ class MarzbanClient:
 
     def get_subscription_link(self, username: str) -> str:
         """Generate subscription link for a user"""
-        # Use panel_url directly since Marzban caches old subscription prefix
-        prefix = self.panel_url.rstrip('/')
-        return f"{prefix}/sub/{username}"
+        return self._sub_base + username
 
     # System Methods
 
@@ -173,6 +294,13 @@ class MarzbanClient:
         """Get system statistics"""
         return await self._request("GET", "/api/system")
 
+    async def warmup(self, connections: int = 4) -> Dict[str, Any]:
+        """Authenticate and open keep-alive connections before serving users"""
+        await self._authenticate()
+        # Parallel requests make the connector establish several sockets up front
+        results = await asyncio.gather(*(self.get_system_stats() for _ in range(connections)))
+        return results[0]
+
     async def get_inbounds(self) -> Dict[str, Any]:
         """Get all inbounds"""
         return await self._request("GET", "/api/inbounds")
@@ -185,22 +313,11 @@ class MarzbanClient:
 
     def calculate_expire_timestamp(self, days: int) -> int:
         """Calculate Unix timestamp for expiry"""
-        return int((datetime.utcnow() + timedelta(days=days)).timestamp())
+        return int(time.time()) + days * 86400
 
     def format_traffic(self, bytes_value: int) -> str:
         """Format bytes to human readable string"""
-        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-            if abs(bytes_value) < 1024.0:
-                return f"{bytes_value:.2f} {unit}"
-            bytes_value /= 1024.0
-        return f"{bytes_value:.2f} PB"
-
+        # Each unit step is 10 bits, so the bit length picks the unit directly
+        idx = min(max(abs(int(bytes_value)).bit_length() - 1, 0) // 10, 5)
+        return f"{bytes_value / (1 << (idx * 10)):.2f} {_TRAFFIC_UNITS[idx]}"
 
-class AuthenticationError(Exception):
-    """Raised when authentication fails"""
-    pass
-
-
-class APIError(Exception):
-    """Raised when API request fails"""
-    pass
@@ -0,0 +1,60 @@
+"""
+Tariffs Module
+Cached access to tariff plans from data/tarifs.json
+"""
+
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+TARIFFS_PATH = Path("data/tarifs.json")
+
+# Parsed tariffs, rebuilt by reload_tariffs only when the file's mtime changes.
+# Handlers only read this dict, so no file I/O happens on the request path
+_TARIFFS_CACHE: Dict[str, Any] = {"mtime": 0, "list": [], "by_id": {}}
+
+
+def _read(mtime: int) -> Optional[Tuple[int, List[Dict[str, Any]]]]:
+    """Stat and parse the tariffs file, or return None if it is unchanged"""
+    stat_mtime = os.stat(TARIFFS_PATH).st_mtime_ns
+    if stat_mtime == mtime:
+        return None
+    return stat_mtime, orjson.loads(TARIFFS_PATH.read_bytes()).get("tariffs", [])
+
+
+async def reload_tariffs():
+    """Reload the tariffs file in a worker thread if it changed since the last load"""
+    loaded = await asyncio.to_thread(_read, _TARIFFS_CACHE["mtime"])
+    if loaded is None:
+        return
+    mtime, tariffs = loaded
+    _TARIFFS_CACHE["list"] = tariffs
+    _TARIFFS_CACHE["by_id"] = {tariff["id"]: tariff for tariff in tariffs}
+    _TARIFFS_CACHE["mtime"] = mtime
+    logger.info(f"Loaded {len(tariffs)} tariffs")
+
+
+def load_tariffs() -> Dict[str, Dict[str, Any]]:
+    """Get tariffs keyed by id"""
+    return _TARIFFS_CACHE["by_id"]
+
+
+def get_tariffs() -> List[Dict[str, Any]]:
+    """Get tariffs in file order"""
+    return _TARIFFS_CACHE["list"]
+
+
+def get_tariffs_version() -> int:
+    """Get the mtime of the loaded tariffs file, usable as a cache key"""
+    return _TARIFFS_CACHE["mtime"]
+
+
+def get_tariff(tariff_id: str) -> Optional[Dict[str, Any]]:
+    """Get a single tariff by id"""
+    return load_tariffs().get(tariff_id)
@@ -0,0 +1,92 @@
+"""
+Throttling Module
+Rate limiting and retries for outgoing Telegram and Marzban API calls
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from typing import Awaitable, Callable
+
+import aiohttp
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+
+def _is_transient(error: Exception) -> bool:
+    """Rate limits, server errors and network failures are worth retrying; 4xx are not"""
+    status = getattr(error, "status", None)
+    return status is None or status == 429 or status >= 500
+
+
+def retry(
+    attempts: int = 3,
+    backoff: tuple = (1, 2, 4),
+    retry_on: tuple = (aiohttp.ClientError, asyncio.TimeoutError)
+):
+    """Retry an async call on transient errors with exponential backoff"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return await func(*args, **kwargs)
+                except retry_on as e:
+                    if attempt == attempts - 1 or not _is_transient(e):
+                        raise
+                    # Honour the server's Retry-After when it sends one
+                    delay = getattr(e, "retry_after", None) or backoff[min(attempt, len(backoff) - 1)]
+                    logger.warning(f"{func.__qualname__} failed: {e}, retrying in {delay}s")
+                    await asyncio.sleep(delay)
+        return wrapper
+    return decorator
+
+
+class TelegramLimiter:
+    """Token bucket keeping outgoing messages under Telegram's global limit"""
+
+    def __init__(self, rate: float = 30, burst: int = 30, max_retries: int = 3):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a send slot is available"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def send_message(self, bot: Bot, chat_id: int, text: str, **kwargs):
+        """Send a message within the rate limit, waiting out flood control"""
+        return await self._send(chat_id, lambda: bot.send_message(chat_id, text, **kwargs))
+
+    async def copy_message(self, message: Message, chat_id: int, **kwargs):
+        """Copy a message to a chat within the rate limit, waiting out flood control"""
+        return await self._send(chat_id, lambda: message.copy_to(chat_id, **kwargs))
+
+    async def _send(self, chat_id: int, call: Callable[[], Awaitable]):
+        """Run one outgoing call per token, retrying after Telegram's flood-control delay"""
+        for attempt in range(self.max_retries + 1):
+            await self.acquire()
+            try:
+                return await call()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {e.retry_after}s")
+                await asyncio.sleep(e.retry_after)